@@ -102,6 +102,16 @@ class PreferencesPithosDialog(Gtk.Dialog):
             "audio_quality": default_audio_quality,
             "pandora_one": False,
             "force_client": None,
+            # Keep expanded Blowfish key schedules next to this file
+            "cache_key_schedules": True,
+            # If set, JSON API call statistics are written here on exit
+            "rpc_stats_file": '',
+            # Size limit of the downloaded audio cache, in MB
+            "audio_cache_size": 2048,
+            # Number of played songs kept in the song list
+            "song_history": 50,
+            # Queue the next song before the current one ends, so there is no gap
+            "gapless_playback": True,
         }
 
         try:
@@ -0,0 +1,87 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+### BEGIN LICENSE
+#This program is free software: you can redistribute it and/or modify it
+#under the terms of the GNU General Public License version 3, as published
+#by the Free Software Foundation.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranties of
+#MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#PURPOSE.  See the GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+# Decoded album art. The image files themselves are downloaded once per URL
+# into the audio cache by Song.download; this keeps the scaled pixbufs of
+# the most recently used ones in memory, up to a byte budget. Entries are
+# keyed by a hash of the image data and the size, so songs whose art comes
+# from different URLs but is the same picture share one pixbuf, and each
+# size it is shown at is decoded once.
+
+import collections
+import contextlib
+import hashlib
+import logging
+import threading
+
+from gi.repository import GdkPixbuf, GLib
+
+PIXBUF_CACHE_SIZE = 16 * 1024**2
+
+def pixbuf_bytes(pixbuf):
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+class PixbufCache(object):
+    def __init__(self, max_bytes=PIXBUF_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pixbufs = collections.OrderedDict() # (sha1, size) -> Pixbuf
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename, size):
+        """Pixbuf of the image in filename scaled to fit size, or None."""
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            logging.warning("Could not read album art %s: %s", filename, e)
+            return None
+
+        key = (hashlib.sha1(data).digest(), size)
+        with self.lock:
+            pixbuf = self.pixbufs.get(key)
+            if pixbuf is not None:
+                self.pixbufs.move_to_end(key)
+                self.hits += 1
+                return pixbuf
+            self.misses += 1
+
+        try:
+            with contextlib.closing(GdkPixbuf.PixbufLoader()) as loader:
+                loader.set_size(size, size)
+                loader.write(data)
+            pixbuf = loader.get_pixbuf()
+        except GLib.Error as e:
+            logging.warning("Could not decode album art %s: %s", filename, e)
+            return None
+
+        with self.lock:
+            if key in self.pixbufs:
+                # Another thread decoded it at the same time
+                return self.pixbufs[key]
+            self.pixbufs[key] = pixbuf
+            self.total += pixbuf_bytes(pixbuf)
+            while self.total > self.max_bytes and len(self.pixbufs) > 1:
+                _, old = self.pixbufs.popitem(last=False)
+                self.total -= pixbuf_bytes(old)
+        return pixbuf
+
+    def get_stats(self):
+        with self.lock:
+            return {'entries': len(self.pixbufs), 'bytes': self.total, 'hits': self.hits, 'misses': self.misses}
+
+pixbuf_cache = PixbufCache()
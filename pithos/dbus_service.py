@@ -15,6 +15,9 @@
 ### END LICENSE
 
 import dbus.service
+import json
+from .util import set_log_level
+from .album_art import pixbuf_cache
 
 DBUS_BUS = "net.kevinmehall.Pithos"
 DBUS_OBJECT_PATH = "/net/kevinmehall/Pithos"
@@ -72,6 +75,25 @@ class PithosDBusProxy(dbus.service.Object):
     @dbus.service.method(DBUS_BUS, out_signature='b')
     def IsPlaying(self):
         return self.window.playing
+
+    @dbus.service.method(DBUS_BUS, in_signature='s')
+    def SetLogLevel(self, level):
+        set_log_level(level)
+
+    @dbus.service.method(DBUS_BUS, out_signature='s')
+    def GetRPCStats(self):
+        return json.dumps(self.window.pandora.stats.snapshot())
+
+    @dbus.service.method(DBUS_BUS, out_signature='s')
+    def GetWorkerStats(self):
+        return json.dumps({
+            'worker': self.window.worker.get_stats(),
+            'art_worker': self.window.art_worker.get_stats(),
+            'downloads': self.window.pandora.downloads.get_stats(),
+            'art_downloads': self.window.pandora.art_downloads.get_stats(),
+            'album_art': pixbuf_cache.get_stats(),
+            'audio_quality': self.window.pandora.quality.get_stats(),
+        })
         
     @dbus.service.signal(DBUS_BUS, signature='b')
     def PlayStateChanged(self, state):
@@ -16,40 +16,209 @@
 
 import logging
 import threading
-import queue
+import asyncio
+import concurrent.futures
+import collections
+import itertools
+import time
 from gi.repository import GObject, GLib
 import traceback
 GObject.threads_init()
 
+PRIORITY_HIGH = -10
+PRIORITY_DEFAULT = 0
+PRIORITY_LOW = 10
+
+class Job():
+    """A command queued on a GObjectWorker. Returned by send() so it can be cancelled."""
+    def __init__(self, worker, seq, command, args, callback, errorback, priority, context):
+        self.worker = worker
+        self.seq = seq
+        self.command = command
+        self.args = args
+        self.callback = callback
+        self.errorback = errorback
+        self.priority = priority
+        self.context = context
+        self.queued_time = time.time()
+        self.cancelled = False
+        self.delivered = False
+
+    def cancel(self):
+        """Drop the job if it is still queued, and never run its callbacks.
+
+        Returns True if a callback or errorback was suppressed or the job
+        never ran, False if its result had already been delivered.
+        """
+        self.cancelled = True
+        self.worker._remove(self)
+        return not self.delivered
+
+    def set_priority(self, priority):
+        with self.worker.condition:
+            self.priority = priority
+
 class GObjectWorker():
+    """Runs commands on a pool of threads, delivering results to the GLib main loop.
+
+    Jobs run in priority order (lowest first, FIFO within a priority).
+    limits caps how many jobs of a context run at once. A context listed in
+    exclusive runs alone: it waits for running jobs to finish, and jobs
+    queued after it wait for it.
+    """
+    def __init__(self, threads=1, limits=None, exclusive=()):
+        self.limits = dict(limits or {})
+        self.exclusive = set(exclusive)
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.running = collections.Counter()
+        self.seq = itertools.count()
+        self.stats = collections.defaultdict(lambda: collections.Counter())
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _next_job(self):
+        if any(self.running[context] for context in self.exclusive):
+            return None
+        barrier = min((job.seq for job in self.jobs if job.context in self.exclusive), default=None)
+        for job in sorted(self.jobs, key=lambda job: (job.priority, job.seq)):
+            if job.context in self.exclusive:
+                if job.seq == barrier and not sum(self.running.values()):
+                    return job
+            elif barrier is not None and job.seq > barrier:
+                continue
+            elif self.running[job.context] < self.limits.get(job.context, len(self.threads)):
+                return job
+
+    def _run(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self._next_job()
+                self.jobs.remove(job)
+                self.running[job.context] += 1
+
+            start = time.time()
+            failed = False
+            try:
+                result = job.command(*job.args)
+                if job.callback:
+                    GLib.idle_add(self._deliver, job, job.callback, result)
+            except Exception as e:
+                failed = True
+                e.traceback = traceback.format_exc()
+                if job.errorback:
+                    GLib.idle_add(self._deliver, job, job.errorback, e)
+            finally:
+                end = time.time()
+                with self.condition:
+                    self.running[job.context] -= 1
+                    stats = self.stats[job.context]
+                    stats['failed' if failed else 'completed'] += 1
+                    stats['wait_total'] += start - job.queued_time
+                    stats['wait_max'] = max(stats['wait_max'], start - job.queued_time)
+                    stats['run_total'] += end - start
+                    self.condition.notify_all()
+
+    def _deliver(self, job, fn, value):
+        if not job.cancelled:
+            job.delivered = True
+            fn(value)
+        return False
+
+    def _remove(self, job):
+        with self.condition:
+            if job in self.jobs:
+                self.jobs.remove(job)
+                self.stats[job.context]['cancelled'] += 1
+                self.condition.notify_all()
+
+    def send(self, command, args=(), callback=None, errorback=None, priority=PRIORITY_DEFAULT, context=None):
+        if errorback is None: errorback = self._default_errorback
+        with self.condition:
+            job = Job(self, next(self.seq), command, args, callback, errorback, priority, context)
+            self.jobs.append(job)
+            self.condition.notify_all()
+        return job
+
+    def cancel(self, context):
+        """Cancel every queued job of a context."""
+        with self.condition:
+            jobs = [job for job in self.jobs if job.context == context]
+        for job in jobs:
+            job.cancel()
+
+    def get_stats(self):
+        """Queue depth and latency per context, in seconds."""
+        with self.condition:
+            queued = collections.Counter(job.context for job in self.jobs)
+            contexts = set(queued) | set(self.running) | set(self.stats)
+            stats = {}
+            for context in contexts:
+                counts = self.stats[context]
+                done = counts['completed'] + counts['failed']
+                stats[str(context)] = {
+                    'queued': queued[context],
+                    'running': self.running[context],
+                    'completed': counts['completed'],
+                    'failed': counts['failed'],
+                    'cancelled': counts['cancelled'],
+                    'wait_avg': counts['wait_total'] / done if done else 0.0,
+                    'wait_max': counts['wait_max'],
+                    'run_avg': counts['run_total'] / done if done else 0.0,
+                }
+            return stats
+
+    def _default_errorback(self, error):
+        logging.error("Unhandled exception in worker thread:\n{}".format(error.traceback))
+
+class AsyncioWorker():
+    """Runs coroutines on an asyncio loop in a background thread.
+
+    Unlike GObjectWorker, any number of coroutines can be in flight at once.
+    Results are delivered to the GLib main loop the same way.
+    """
     def __init__(self):
+        self.loop = asyncio.new_event_loop()
         self.thread = threading.Thread(target=self._run)
         self.thread.daemon = True
-        self.queue = queue.Queue()
         self.thread.start()
-        
+
     def _run(self):
-        while True:
-            command, args, callback, errorback = self.queue.get()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def send(self, coroutine, callback=None, errorback=None):
+        if errorback is None: errorback = self._default_errorback
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+        def done(future):
             try:
-                result = command(*args)
-                if callback:
-                    GLib.idle_add(callback, result)
+                result = future.result()
+            except concurrent.futures.CancelledError:
+                return
             except Exception as e:
-                e.traceback = traceback.format_exc()
+                e.traceback = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
                 if errorback:
                     GLib.idle_add(errorback, e)
-                
-    def send(self, command, args=(), callback=None, errorback=None):
-        if errorback is None: errorback = self._default_errorback
-        self.queue.put((command, args, callback, errorback))
-        
+            else:
+                if callback:
+                    GLib.idle_add(callback, result)
+
+        future.add_done_callback(done)
+        return future
+
     def _default_errorback(self, error):
-        logging.error("Unhandled exception in worker thread:\n{}".format(error.traceback))
+        logging.error("Unhandled exception in asyncio worker:\n{}".format(error.traceback))
         
 if __name__ == '__main__':
     worker = GObjectWorker()
-    import time
     from gi.repository import Gtk
     
     def test_cmd(a, b):
@@ -47,7 +47,7 @@ class PithosMprisService(dbus.service.Object):
             self.signal_paused()
         
     def songchange_handler(self, window, song):
-        self.song_changed([song.artist], song.album, song.title, song.artRadio)
+        self.song_changed([song.artist], song.album, song.title, song.art_url)
         self.signal_playing()
 
     def song_changed(self, artists = None, album = None, title = None, artUrl=''):
@@ -22,3 +22,11 @@ def make_pandora(testing=False):
         return FakePandora()
     else:
         return Pandora()
+
+def make_async_pandora(testing=False):
+    if testing:
+        from pithos.pandora.fake import FakeAsyncPandora
+        return FakeAsyncPandora()
+    else:
+        from pithos.pandora.async_pandora import AsyncPandora
+        return AsyncPandora()
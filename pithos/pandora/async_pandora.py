@@ -0,0 +1,144 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+### BEGIN LICENSE
+#This program is free software: you can redistribute it and/or modify it
+#under the terms of the GNU General Public License version 3, as published
+#by the Free Software Foundation.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranties of
+#MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#PURPOSE.  See the GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+# Coroutine counterpart of the Pandora client. Requests are built and parsed
+# by the same code as Pandora; only the network round trip is awaited. It is
+# handed to a small thread pool sharing the keep-alive HTTPConnectionPool, so
+# several calls can be in flight at once. Use gobject_worker.AsyncioWorker
+# to run these coroutines from the GLib main loop.
+
+import asyncio
+import concurrent.futures
+import logging
+
+from .pandora import *
+
+ASYNC_MAX_REQUESTS = 4
+
+class AsyncPandora(Pandora):
+    def __init__(self, services=None):
+        super(AsyncPandora, self).__init__(services)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_MAX_REQUESTS)
+
+    async def json_call(self, method, args={}, https=False, blowfish=True):
+        url, data = self.build_request(method, args, https, blowfish)
+        loop = asyncio.get_running_loop()
+        with self.stats.call(method, len(data)) as call:
+            body = await loop.run_in_executor(self.executor, self.send_request, url, data, call)
+            call.received = len(body)
+            return self.parse_response(body)
+
+    async def connect(self, client, user, password):
+        self.set_client(client)
+
+        partner = await self.json_call('auth.partnerLogin', partner_login_args(client), https=True, blowfish=False)
+        self.set_partner(partner)
+
+        user = await self.json_call('auth.userLogin', {'username': user, 'password': password, 'loginType': 'user'}, https=True)
+        self.userId = user['userId']
+        self.userAuthToken = user['userAuthToken']
+
+        await self.get_stations()
+
+    async def get_stations(self, *ignore):
+        self.load_stations((await self.json_call('user.getStationList'))['stations'])
+
+    def make_station(self, d):
+        return AsyncStation(self, d)
+
+    async def save_quick_mix(self):
+        stationIds = [i.id for i in self.stations if i.useQuickMix]
+        await self.json_call('user.setQuickMix', {'quickMixStationIds': stationIds})
+
+    async def search(self, query):
+        return self.sort_search_results(await self.json_call('music.search', {'searchText': query}))
+
+    async def add_station_by_music_id(self, musicid):
+        d = await self.json_call('station.createStation', {'musicToken': musicid})
+        station = self.make_station(d)
+        self.stations.append(station)
+        return station
+
+    async def add_feedback(self, trackToken, rating):
+        logging.info("pandora: addFeedback")
+        rating_bool = True if rating == RATE_LOVE else False
+        feedback = await self.json_call('station.addFeedback', {'trackToken': trackToken, 'isPositive': rating_bool})
+        return feedback['feedbackId']
+
+    async def delete_feedback(self, stationToken, feedbackId):
+        await self.json_call('station.deleteFeedback', {'feedbackId': feedbackId, 'stationToken': stationToken})
+
+class AsyncStation(Station):
+    __slots__ = ()
+
+    async def transformIfShared(self):
+        if not self.isCreator:
+            logging.info("pandora: transforming station")
+            await self.pandora.json_call('station.transformSharedStation', {'stationToken': self.idToken})
+            self.isCreator = True
+
+    async def get_playlist(self):
+        logging.info("pandora: Get Playlist")
+        playlist = await self.pandora.json_call('station.getPlaylist', {'stationToken': self.idToken}, https=True)
+        return self.load_playlist(playlist)
+
+    def make_song(self, d):
+        return AsyncSong(self.pandora, d)
+
+    async def rename(self, new_name):
+        if new_name != self.name:
+            await self.transformIfShared()
+            logging.info("pandora: Renaming station")
+            await self.pandora.json_call('station.renameStation', {'stationToken': self.idToken, 'stationName': new_name})
+            self.name = new_name
+
+    async def delete(self):
+        logging.info("pandora: Deleting Station")
+        await self.pandora.json_call('station.deleteStation', {'stationToken': self.idToken})
+
+class AsyncSong(Song):
+    __slots__ = ()
+
+    async def rate(self, rating):
+        if self.rating != rating:
+            await self.send_rating_async(rating, self.rating)
+            self.rating = rating
+
+    def send_rating(self, rating, old_rating):
+        # Called by queue_rating's FeedbackQueue from its own thread, which
+        # has no event loop; the requests still go through the executor.
+        asyncio.run(self.send_rating_async(rating, old_rating))
+
+    async def send_rating_async(self, rating, old_rating):
+        await self.station.transformIfShared()
+        if rating == RATE_NONE:
+            if not self.feedbackId:
+                # See Song.send_rating
+                opposite = RATE_BAN if old_rating == RATE_LOVE else RATE_LOVE
+                self.feedbackId = await self.pandora.add_feedback(self.trackToken, opposite)
+            await self.pandora.delete_feedback(self.station.idToken, self.feedbackId)
+        else:
+            self.feedbackId = await self.pandora.add_feedback(self.trackToken, rating)
+
+    async def set_tired(self):
+        if not self.tired:
+            await self.pandora.json_call('user.sleepSong', {'trackToken': self.trackToken})
+            self.tired = True
+
+    async def bookmark(self):
+        await self.pandora.json_call('bookmark.addSongBookmark', {'trackToken': self.trackToken})
+
+    async def bookmark_artist(self):
+        await self.pandora.json_call('bookmark.addArtistBookmark', {'trackToken': self.trackToken})
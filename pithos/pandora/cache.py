@@ -0,0 +1,222 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+### BEGIN LICENSE
+#This program is free software: you can redistribute it and/or modify it
+#under the terms of the GNU General Public License version 3, as published
+#by the Free Software Foundation.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranties of
+#MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#PURPOSE.  See the GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+# Size-bounded cache for downloaded audio and cover art.
+#
+# Files are named after a hash of what they contain (see Song.cache_name),
+# not after the station they were played on, so a track is only fetched
+# once. An index of sizes and last access times lives next to the files;
+# when the cache grows past its budget the least recently used entries are
+# deleted. Entries used within min_age are never evicted, which keeps the
+# current song and the rest of a not-yet-expired playlist on disk.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+DEFAULT_CACHE_SIZE = 2 * 1024**3
+CACHE_MIN_AGE = 60*60*3
+INDEX_FILENAME = 'index.json'
+PART_SUFFIX = '.part'
+
+def cache_key(*parts):
+    """Stable cache name stem for the given identifying strings."""
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+def copy_file(src, dst):
+    """Copy src to dst in the kernel where possible, never leaving dst half written."""
+    tmp = dst + PART_SUFFIX
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except (AttributeError, OSError):
+                # No sendfile() to regular files on this platform
+                fsrc.seek(offset)
+                fdst.seek(offset)
+                shutil.copyfileobj(fsrc, fdst)
+        os.replace(tmp, dst)
+    except BaseException:
+        # dst may be outside the cache (the Music folder), where nothing
+        # would ever clean up after us
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+def link_file(src, dst):
+    """Hard link src as dst, copying if a link is not possible."""
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        copy_file(src, dst)
+
+class AudioCache(object):
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE, min_age=CACHE_MIN_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.lock = threading.RLock()
+        self.entries = {} # name -> {'size': bytes, 'atime': last access}
+        self.total = 0
+        self._load()
+        self._remove_stale_parts()
+
+    def path(self, name):
+        """Where the file for name lives (whether or not it is cached yet)."""
+        return os.path.join(self.directory, name[:2], name)
+
+    def prepare(self, name):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+
+    def lookup(self, name):
+        """Return the path of a cached file and mark it used, or None."""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            path = self.path(name)
+            if not os.path.isfile(path):
+                self._forget(name)
+                self._save()
+                return None
+            entry['atime'] = time.time()
+            self._save()
+            return path
+
+    def add(self, name):
+        """Record a file that has been written to path(name)."""
+        size = os.path.getsize(self.path(name))
+        with self.lock:
+            self._forget(name)
+            self.entries[name] = {'size': size, 'atime': time.time()}
+            self.total += size
+            self._evict()
+            self._save()
+
+    def remove(self, name):
+        with self.lock:
+            self._forget(name)
+            self._save()
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def link_out(self, name, dst):
+        """Make a cached file also available as dst, leaving it cached.
+
+        Returns False if there is no such file. A file that has been written
+        but not add()ed yet is linked too.
+        """
+        path = self.lookup(name)
+        if path is None:
+            if not os.path.isfile(self.path(name)):
+                return False
+            path = self.path(name)
+        link_file(path, dst)
+        return True
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+            self._save()
+
+    def _forget(self, name):
+        entry = self.entries.pop(name, None)
+        if entry:
+            self.total -= entry['size']
+
+    def _evict(self):
+        if self.total <= self.max_bytes:
+            return
+        cutoff = time.time() - self.min_age
+        for name, entry in sorted(self.entries.items(), key=lambda item: item[1]['atime']):
+            if self.total <= self.max_bytes:
+                break
+            if entry['atime'] > cutoff:
+                logging.info("Audio cache is %d bytes over budget, but everything left is in use", self.total - self.max_bytes)
+                break
+            logging.debug("Evicting %s from audio cache", name)
+            self._forget(name)
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILENAME)) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self._scan()
+        except (IOError, ValueError) as e:
+            logging.warning("Rebuilding audio cache index: %s", e)
+            self._scan()
+        self.total = sum(entry['size'] for entry in self.entries.values())
+
+    def _scan(self):
+        """Rebuild the index from the files on disk, skipping partial downloads."""
+        self.entries = {}
+        if not os.path.isdir(self.directory):
+            return
+        for subdir in os.listdir(self.directory):
+            subpath = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for name in os.listdir(subpath):
+                path = os.path.join(subpath, name)
+                if name.endswith(PART_SUFFIX):
+                    continue
+                st = os.stat(path)
+                self.entries[name] = {'size': st.st_size, 'atime': st.st_mtime}
+
+    def _remove_stale_parts(self):
+        """Delete partial downloads too old to be worth resuming."""
+        if not os.path.isdir(self.directory):
+            return
+        cutoff = time.time() - self.min_age
+        for subdir in os.listdir(self.directory):
+            subpath = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for name in os.listdir(subpath):
+                path = os.path.join(subpath, name)
+                if name.endswith(PART_SUFFIX) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+
+    def _save(self):
+        index = os.path.join(self.directory, INDEX_FILENAME)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(index + '.tmp', 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(index + '.tmp', index)
+        except (IOError, OSError) as e:
+            logging.warning("Could not save audio cache index: %s", e)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+### BEGIN LICENSE
+#This program is free software: you can redistribute it and/or modify it
+#under the terms of the GNU General Public License version 3, as published
+#by the Free Software Foundation.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranties of
+#MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#PURPOSE.  See the GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+# Blowfish backend selection. A native implementation from either
+# cryptography or pycryptodome is used when one is installed and passes
+# the self test below; otherwise we fall back to the pure-Python cipher in
+# blowfish.py. All backends take the key in the constructor and expose
+# ECB encrypt(data)/decrypt(data) on 8-byte aligned buffers.
+
+import json
+import logging
+
+from . import blowfish
+from .data import client_keys
+
+class CryptographyBlowfish(object):
+    name = 'cryptography'
+
+    def __init__(self, key):
+        self.cipher = Cipher(_cryptography_algorithm(key), modes.ECB(), backend=default_backend())
+
+    def encrypt(self, data):
+        encryptor = self.cipher.encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt(self, data):
+        decryptor = self.cipher.decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+class PyCryptodomeBlowfish(object):
+    name = 'pycryptodome'
+
+    def __init__(self, key):
+        self.cipher = _PyCryptodomeCipher.new(key, _PyCryptodomeCipher.MODE_ECB)
+
+    def encrypt(self, data):
+        return self.cipher.encrypt(data)
+
+    def decrypt(self, data):
+        return self.cipher.decrypt(data)
+
+class PythonBlowfish(blowfish.Blowfish):
+    name = 'python'
+
+native_backends = []
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, modes
+    from cryptography.hazmat.backends import default_backend
+    try:
+        # Blowfish moved to the "decrepit" module in cryptography 43
+        from cryptography.hazmat.decrepit.ciphers.algorithms import Blowfish as _cryptography_algorithm
+    except ImportError:
+        from cryptography.hazmat.primitives.ciphers.algorithms import Blowfish as _cryptography_algorithm
+    native_backends.append(CryptographyBlowfish)
+except ImportError:
+    pass
+
+try:
+    from Crypto.Cipher import Blowfish as _PyCryptodomeCipher
+    native_backends.append(PyCryptodomeBlowfish)
+except ImportError:
+    pass
+
+def _sample_payloads():
+    """Plaintexts shaped like what Pandora.json_call sends and receives."""
+    payloads = [
+        json.dumps({'stationToken': '345434', 'syncTime': 1400000000,
+                    'userAuthToken': 'XXfcfa2b7c8ee7e1e0c3a1e6a6e1df2c2a'}).encode('utf-8'),
+        json.dumps({'quickMixStationIds': [str(i) * 18 for i in range(100)],
+                    'syncTime': 1400000000}).encode('utf-8'),
+        b'\x8b\x1d\xe4\x07' + b'1400000000' + b'\x02\x02',
+    ]
+    return [p + b'\0' * (-len(p) % 8) for p in payloads]
+
+def self_test(backend, reference=PythonBlowfish):
+    """Check *backend* is byte-identical to *reference* on Pandora payloads.
+
+    Every partner key in :data:`client_keys` is tried in both directions.
+    Returns True on success; any mismatch or exception returns False.
+
+    """
+    try:
+        for client in client_keys.values():
+            for key in (client['encryptKey'], client['decryptKey']):
+                key = key.encode('utf-8')
+                ours, theirs = backend(key), reference(key)
+                for payload in _sample_payloads():
+                    if ours.encrypt(payload) != theirs.encrypt(payload):
+                        return False
+                    if ours.decrypt(payload) != theirs.decrypt(payload):
+                        return False
+    except Exception as e:
+        logging.warning("Blowfish backend %s failed self test: %s", backend.name, e)
+        return False
+    return True
+
+def select_backend():
+    for backend in native_backends:
+        if self_test(backend):
+            return backend
+        logging.warning("Blowfish backend %s does not match the reference implementation, not using it", backend.name)
+    return PythonBlowfish
+
+Blowfish = select_backend()
+logging.info("Using %s Blowfish backend", Blowfish.name)
+
+if __name__ == '__main__':
+    for backend in native_backends:
+        print('%-12s %s' % (backend.name, 'ok' if self_test(backend) else 'MISMATCH'))
+    print('selected     %s' % Blowfish.name)
@@ -26,5 +26,6 @@ valid_audio_formats = [
     ('highQuality', 'High'),
     ('mediumQuality', 'Medium'),
     ('lowQuality', 'Low'),
+    ('automatic', 'Automatic'), # see quality.py
 ]
 default_audio_quality = 'mediumQuality'
@@ -0,0 +1,383 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+### BEGIN LICENSE
+#This program is free software: you can redistribute it and/or modify it
+#under the terms of the GNU General Public License version 3, as published
+#by the Free Software Foundation.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranties of
+#MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#PURPOSE.  See the GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+# Song and cover art downloads share a small fixed pool of threads instead
+# of starting one thread per song. Downloads run in priority order (lowest
+# first, FIFO within a priority) so the song about to play is not starved
+# by prefetches for the rest of the playlist.
+#
+# Data is written to filename + PART_SUFFIX. After a network error the
+# download picks up where it left off with an HTTP Range request, and only
+# once the length matches what the server promised is the file renamed to
+# its real name. A complete file is therefore never mistaken for a partial
+# one or the other way around.
+
+import http.client
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+
+from .cache import PART_SUFFIX
+
+DOWNLOAD_THREADS = 2
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_RETRY_DELAY = 1 # seconds, doubled after every failure
+CONTENT_RANGE_REGEX = re.compile(r'bytes (\d+)-\d+/(\d+)')
+
+# Same scale as gobject_worker
+PRIORITY_HIGH = -10
+PRIORITY_DEFAULT = 0
+PRIORITY_LOW = 10
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+class DownloadCancelled(Exception):
+    pass
+
+class IncompleteDownload(Exception):
+    pass
+
+class Download(object):
+    """A file queued on a DownloadManager. Returned by fetch()."""
+    def __init__(self, manager, seq, url, filename, priority, reporthook):
+        self.manager = manager
+        self.seq = seq
+        self.url = url
+        self.filename = filename
+        self.part_filename = filename + PART_SUFFIX
+        self.priority = priority
+        self.callbacks = []
+        self.errorbacks = []
+        self.reporthook = reporthook
+        self.state = QUEUED
+        self.received = 0
+        self.total = None
+        self.error = None
+        self.retries = 0
+        self.transferred = 0 # bytes read from the network, over all attempts
+        # Seconds spent running, each divided by how many downloads were
+        # running then, so transferred / this estimates the link speed
+        self.shared_seconds = 0.0
+        self.queued_time = time.time()
+        self.finished = threading.Event()
+        self.progressed = threading.Condition()
+
+    @property
+    def progress(self):
+        """Fraction downloaded, or None if the size is not known yet."""
+        if self.state == DONE:
+            return 1.0
+        if not self.total:
+            return None
+        return min(self.received / self.total, 1.0)
+
+    def cancel(self):
+        """Stop the download, removing the partial file.
+
+        Returns True if the download had not completed.
+        """
+        with self.manager.condition:
+            if self.state in (DONE, FAILED, CANCELLED):
+                return False
+            if self.state == QUEUED:
+                self.manager.queue.remove(self)
+                del self.manager.pending[self.filename]
+                self.manager.cancelled += 1
+                self._finish(CANCELLED)
+            else:
+                # The transfer loop notices between chunks. Until then its
+                # thread still owns the file, so a new fetch() of it gets a
+                # new Download that waits for this one to stop.
+                self.state = CANCELLED
+                if self.manager.pending.get(self.filename) is self:
+                    del self.manager.pending[self.filename]
+            return True
+
+    def set_priority(self, priority):
+        with self.manager.condition:
+            self.priority = priority
+
+    def add_callback(self, callback):
+        """Also call callback(download) on success.
+
+        Returns False, without adding it, if the download already finished.
+        """
+        with self.manager.condition:
+            if self.finished.is_set():
+                return False
+            self.callbacks.append(callback)
+            return True
+
+    def wait(self, timeout=None):
+        """Block until the download completes, fails or is cancelled."""
+        return self.finished.wait(timeout)
+
+    def wait_for_data(self, offset, timeout=None):
+        """Block until more than offset bytes are on disk or the download ends."""
+        with self.progressed:
+            return self.progressed.wait_for(lambda: self.received > offset or self.finished.is_set(), timeout)
+
+    def _finish(self, state):
+        with self.progressed:
+            self.state = state
+            self.finished.set()
+            self.progressed.notify_all()
+
+class DownloadManager(object):
+    def __init__(self, threads=DOWNLOAD_THREADS):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.active = set()
+        self.pending = {} # filename -> queued or running Download
+        self.seq = itertools.count()
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.shared_time = time.time()
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def fetch(self, url, filename, priority=PRIORITY_DEFAULT, callback=None, errorback=None, reporthook=None):
+        """Queue url to be saved as filename, unless it already exists.
+
+        callback(download) or errorback(download, error) is called from the
+        download thread when it finishes. reporthook has the same signature
+        as urlretrieve's. If filename is already being downloaded the
+        callbacks are added to that download and it is returned instead, so
+        cancelling it cancels it for every caller.
+        """
+        with self.condition:
+            download = self.pending.get(filename)
+            if download is None:
+                download = Download(self, next(self.seq), url, filename, priority, reporthook)
+                self.pending[filename] = download
+                self.queue.append(download)
+                self.condition.notify()
+            else:
+                download.priority = min(download.priority, priority)
+            if callback:
+                download.callbacks.append(callback)
+            if errorback:
+                download.errorbacks.append(errorback)
+        return download
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    # Not a file a cancelled download is still writing
+                    busy = {d.filename for d in self.active}
+                    ready = [d for d in self.queue if d.filename not in busy]
+                    if ready:
+                        break
+                    self.condition.wait()
+                download = min(ready, key=lambda d: (d.priority, d.seq))
+                self.queue.remove(download)
+                download.state = RUNNING
+                self._share_time()
+                self.active.add(download)
+
+            try:
+                already_complete = self._transfer_with_retries(download)
+            except DownloadCancelled:
+                logging.debug("Download of %s cancelled", download.url)
+                self._remove_partial(download)
+                state = CANCELLED
+            except Exception as e:
+                # The partial file is kept so a later attempt can resume
+                e.traceback = traceback.format_exc()
+                download.error = e
+                state = FAILED
+            else:
+                state = DONE
+
+            with self.condition:
+                self._share_time()
+                self.active.discard(download)
+                if self.pending.get(download.filename) is download:
+                    del self.pending[download.filename]
+                self.condition.notify_all()
+                if state == DONE and download.state == CANCELLED:
+                    # Cancelled after the last chunk; the file is complete
+                    # but nobody wants it any more.
+                    self._remove_partial(download)
+                    state = CANCELLED
+                elif state == DONE and not already_complete:
+                    try:
+                        os.replace(download.part_filename, download.filename)
+                    except OSError as e:
+                        e.traceback = traceback.format_exc()
+                        download.error = e
+                        state = FAILED
+                download._finish(state)
+                if state == DONE:
+                    self.completed += 1
+                elif state == FAILED:
+                    self.failed += 1
+                else:
+                    self.cancelled += 1
+
+                if state == DONE:
+                    callbacks = [(fn, (download,)) for fn in download.callbacks]
+                elif state == FAILED:
+                    callbacks = [(fn, (download, download.error)) for fn in download.errorbacks]
+                else:
+                    callbacks = []
+
+            if state == FAILED and not callbacks:
+                logging.error("Download of %s failed:\n%s", download.url, download.error.traceback)
+            for fn, args in callbacks:
+                try:
+                    fn(*args)
+                except Exception:
+                    logging.error("Unhandled exception in download callback:\n%s", traceback.format_exc())
+
+    def _share_time(self):
+        """Split the time since the last call between the running downloads."""
+        now = time.time()
+        if self.active:
+            share = (now - self.shared_time) / len(self.active)
+            for download in self.active:
+                download.shared_seconds += share
+        self.shared_time = now
+
+    def _transfer_with_retries(self, download):
+        """Returns True if the file was already there, so there is no .part file."""
+        if os.path.isfile(download.filename):
+            download.received = download.total = os.path.getsize(download.filename)
+            return True
+        delay = DOWNLOAD_RETRY_DELAY
+        while True:
+            try:
+                self._transfer(download)
+                return False
+            except urllib.error.HTTPError as e:
+                if e.code < 500:
+                    # Expired or bad URL; retrying will not help
+                    raise
+                error = e
+            except (OSError, http.client.HTTPException, IncompleteDownload) as e:
+                error = e
+            if download.retries >= DOWNLOAD_RETRIES:
+                raise error
+            download.retries += 1
+            logging.info("Download of %s interrupted at %d bytes (%s), retrying in %ds",
+                         download.url, download.received, error, delay)
+            deadline = time.time() + delay
+            while time.time() < deadline:
+                if download.state == CANCELLED:
+                    raise DownloadCancelled()
+                time.sleep(0.1)
+            delay *= 2
+
+    def _transfer(self, download):
+        try:
+            offset = os.path.getsize(download.part_filename)
+        except FileNotFoundError:
+            offset = 0
+        request = urllib.request.Request(download.url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # Our partial file is no good for this URL; start over
+            os.remove(download.part_filename)
+            return self._transfer(download)
+
+        with response:
+            length = response.getheader('Content-Length')
+            content_range = CONTENT_RANGE_REGEX.match(response.getheader('Content-Range', ''))
+            if response.status == 206 and content_range and int(content_range.group(1)) == offset:
+                total = int(content_range.group(2))
+                mode = 'ab'
+            else:
+                # The server ignored the Range header
+                offset = 0
+                total = int(length) if length else None
+                mode = 'wb'
+            if download.total is not None and total is not None and total != download.total:
+                logging.warning("Size of %s changed from %d to %d bytes", download.url, download.total, total)
+            with download.progressed:
+                download.total = total
+                download.received = offset
+                download.progressed.notify_all()
+
+            with open(download.part_filename, mode) as f:
+                blocks = offset // DOWNLOAD_CHUNK_SIZE
+                if download.reporthook:
+                    download.reporthook(blocks, DOWNLOAD_CHUNK_SIZE, download.total or -1)
+                while True:
+                    if download.state == CANCELLED:
+                        raise DownloadCancelled()
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    # Readers of the partial file (see stream.py) only look
+                    # at what has been flushed
+                    f.flush()
+                    download.transferred += len(chunk)
+                    with download.progressed:
+                        download.received += len(chunk)
+                        download.progressed.notify_all()
+                    blocks += 1
+                    if download.reporthook:
+                        download.reporthook(blocks, DOWNLOAD_CHUNK_SIZE, download.total or -1)
+
+        if download.total is not None and download.received != download.total:
+            raise IncompleteDownload("got %d of %d bytes" % (download.received, download.total))
+
+    def _remove_partial(self, download):
+        try:
+            os.remove(download.part_filename)
+        except FileNotFoundError:
+            pass
+
+    def get_stats(self):
+        """Counters plus progress of every queued and running download."""
+        with self.condition:
+            downloads = sorted(self.active, key=lambda d: d.seq) + sorted(self.queue, key=lambda d: (d.priority, d.seq))
+            return {
+                'completed': self.completed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'downloads': [{
+                    'url': d.url,
+                    'state': d.state,
+                    'priority': d.priority,
+                    'received': d.received,
+                    'total': d.total,
+                    'age': time.time() - d.queued_time,
+                } for d in downloads],
+            }
@@ -15,14 +15,16 @@
 ### END LICENSE
 
 from pithos.pandora.pandora import *
+from pithos.pandora.async_pandora import AsyncPandora
 from gi.repository import Gtk
+import asyncio
 import logging
 
 TEST_FILE = "http://pithos.github.io/testfile.aac"
 
 class FakePandora(Pandora):
-    def __init__(self):
-        super(FakePandora, self).__init__()
+    def __init__(self, services=None):
+        super(FakePandora, self).__init__(services)
         self.counter = 0
         self.show_fail_window()
         logging.info("Using test mode")
@@ -48,6 +50,9 @@ class FakePandora(Pandora):
         if self.time_check.get_active():
             logging.info("fake: Going to sleep for 10s")
             time.sleep(10)
+        self.check_auth()
+
+    def check_auth(self):
         if not self.auth_check.get_active():
             logging.info("fake: We're deauthenticated...")
             raise PandoraAuthTokenInvalid("Auth token invalid", "AUTH_INVALID_TOKEN")
@@ -58,7 +63,9 @@ class FakePandora(Pandora):
     def json_call(self, method, args={}, https=False, blowfish=True):
         time.sleep(1)
         self.maybe_fail()
+        return self.fake_response(method, args)
 
+    def fake_response(self, method, args):
         if method == 'user.getStationList':
             return {'stations': [
                 {'stationId':'987', 'stationToken':'345434', 'isShared':False, 'isQuickMix':False, 'stationName':"Test Station 1"},
@@ -133,3 +140,15 @@ class FakePandora(Pandora):
             'songExplorerUrl':'http://pithos.github.io/test-song.xml',
         }
 
+class FakeAsyncPandora(AsyncPandora, FakePandora):
+    async def json_call(self, method, args={}, https=False, blowfish=True):
+        await asyncio.sleep(1)
+        if self.time_check.get_active():
+            logging.info("fake: Going to sleep for 10s")
+            await asyncio.sleep(10)
+        self.check_auth()
+        return self.fake_response(method, args)
+
+    async def connect(self, client, user, password):
+        self.set_authenticated()
+        await self.get_stations()
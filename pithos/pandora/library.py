@@ -0,0 +1,127 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+### BEGIN LICENSE
+#This program is free software: you can redistribute it and/or modify it
+#under the terms of the GNU General Public License version 3, as published
+#by the Free Software Foundation.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranties of
+#MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#PURPOSE.  See the GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+# Index of the songs stored in the Music folder, so checking whether a song
+# is already stored is a primary key lookup rather than a filesystem probe.
+# Paths are relative to the Music folder (station/artist/album/song.mp4).
+# Song.store() keeps it up to date; rescan() rebuilds it from disk, and is
+# run automatically the first time so existing Music folders are picked up.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    track_token TEXT,
+    station TEXT,
+    artist TEXT,
+    album TEXT,
+    title TEXT,
+    size INTEGER,
+    duration REAL,
+    bitrate INTEGER,
+    stored_time REAL
+);
+CREATE INDEX IF NOT EXISTS tracks_track_token ON tracks (track_token);
+"""
+
+class Library(object):
+    def __init__(self, filename, music_dir):
+        self.filename = filename
+        self.music_dir = music_dir
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            new = not os.path.exists(self.filename)
+            # Songs are stored from download and worker threads
+            self.db = sqlite3.connect(self.filename, check_same_thread=False)
+            self.db.row_factory = sqlite3.Row
+            self.db.executescript(SCHEMA)
+            if new:
+                self._rescan(self.db)
+        return self.db
+
+    def lookup(self, path):
+        """Return the row for a relative path as a dict, or None."""
+        with self.lock:
+            row = self._connect().execute('SELECT * FROM tracks WHERE path = ?', (path,)).fetchone()
+        return dict(row) if row else None
+
+    def lookup_token(self, track_token):
+        with self.lock:
+            row = self._connect().execute('SELECT * FROM tracks WHERE track_token = ?', (track_token,)).fetchone()
+        return dict(row) if row else None
+
+    def add(self, path, track_token=None, station=None, artist=None, album=None, title=None,
+            duration=None, bitrate=None):
+        size = os.path.getsize(os.path.join(self.music_dir, path))
+        with self.lock, self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (path, track_token, station, artist, album, title, size, duration, bitrate, time.time()))
+
+    def remove(self, path):
+        with self.lock, self._connect() as db:
+            db.execute('DELETE FROM tracks WHERE path = ?', (path,))
+
+    def __len__(self):
+        with self.lock:
+            return self._connect().execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+
+    def rescan(self):
+        """Make the index match the Music folder. Returns the number of tracks.
+
+        Songs found on disk but not in the index get their names from their
+        folders; what is already known about indexed songs is kept.
+        """
+        with self.lock:
+            return self._rescan(self._connect())
+
+    def _rescan(self, db):
+        found = {}
+        for root, dirs, files in os.walk(self.music_dir):
+            for name in files:
+                if not name.endswith('.mp4'):
+                    continue
+                full = os.path.join(root, name)
+                found[os.path.relpath(full, self.music_dir)] = (full, os.path.getsize(full))
+
+        with db:
+            known = {row[0]: row[1] for row in db.execute('SELECT path, size FROM tracks')}
+            db.executemany('DELETE FROM tracks WHERE path = ?', [(path,) for path in known if path not in found])
+            for path, (full, size) in found.items():
+                if path in known:
+                    if known[path] != size:
+                        db.execute('UPDATE tracks SET size = ? WHERE path = ?', (size, path))
+                    continue
+                parts = path.split(os.sep)
+                station, artist, album = parts[:3] if len(parts) == 4 else (None, None, None)
+                db.execute('INSERT INTO tracks (path, station, artist, album, title, size, stored_time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (path, station, artist, album, os.path.splitext(parts[-1])[0], size, os.path.getmtime(full)))
+        logging.info("Library rescan: %d tracks, %d added, %d removed", len(found),
+                     len(set(found) - set(known)), len(set(known) - set(found)))
+        return len(found)
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
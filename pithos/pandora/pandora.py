@@ -15,27 +15,38 @@
 #with this program.  If not, see <http://www.gnu.org/licenses/>.
 ### END LICENSE
 
-from .blowfish import Blowfish
-# from Crypto.Cipher import Blowfish
+from .cipher import Blowfish
 from xml.dom import minidom
+from xml.parsers.expat import ExpatError
 import re
 import json
 import logging
 import time
 import urllib.request, urllib.parse, urllib.error
+import http.client
+import base64
+import socket
+import ssl
 import codecs
 import os
 import sys
 import urllib.request
 import threading
+import traceback
 import string
-import shutil
+from pithos.util import parse_proxy, tracing, TracePayload
+from .cache import AudioCache, cache_key
+from .download import DownloadManager, CANCELLED, DONE, FAILED, PRIORITY_HIGH, PRIORITY_DEFAULT, PRIORITY_LOW
+from .stream import StreamServer
+from .library import Library
+from .quality import QualitySelector, AUTOMATIC_QUALITY
 
 # This is an implementation of the Pandora JSON API using Android partner
 # credentials.
 # See http://pan-do-ra-api.wikia.com/wiki/Json/5 for API documentation.
 
 HTTP_TIMEOUT = 30
+HTTP_IDLE_TIMEOUT = 60
 USER_AGENT = 'pithos'
 
 RATE_BAN = 'ban'
@@ -54,6 +65,15 @@ API_ERROR_PLAYLIST_EXCEEDED = 1039
 
 PLAYLIST_VALIDITY_TIME = 60*60*3
 
+FEEDBACK_DELAY = 2
+FEEDBACK_RETRIES = 3
+FEEDBACK_FLUSH_TIMEOUT = 5
+
+TITLE_CACHE_SIZE = 10000 # explorer URL -> title entries kept on disk
+
+# Upper bounds, in milliseconds, of the RPC latency histogram buckets
+RPC_LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
 NAME_COMPARE_REGEX = re.compile(r'[^A-Za-z0-9]')
 
 class PandoraError(IOError):
@@ -70,18 +90,451 @@ class PandoraTimeout(PandoraNetError): pass
 def pad(s, l):
     return s + b'\0' * (l - len(s))
 
-class Pandora(object):
+def partner_login_args(client):
+    return {
+        'deviceModel': client['deviceModel'],
+        'username': client['username'], # partner username
+        'password': client['password'], # partner password
+        'version': client['version']
+    }
+
+class HTTPConnectionPool(object):
+    """Keep-alive HTTP(S) connections for the JSON API, pooled per scheme and host.
+
+    Proxies are taken from the ProxyHandler of the urllib opener given to
+    set_opener, so the pool goes through the same proxy the opener would.
+    Errors are reported as urllib.error exceptions, like opener.open.
+    """
+
+    def __init__(self, opener=None, timeout=HTTP_TIMEOUT, idle_timeout=HTTP_IDLE_TIMEOUT):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {} # (scheme, host) -> [(connection, last used), ...]
+        self.ssl_context = ssl.create_default_context()
+        self.set_opener(opener)
+
+    def set_opener(self, opener):
+        self.proxies = {}
+        if opener is not None:
+            for handler in opener.handlers:
+                if isinstance(handler, urllib.request.ProxyHandler):
+                    self.proxies = dict(handler.proxies)
+        self.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+    def _get_proxy(self, scheme, host):
+        proxy = self.proxies.get(scheme)
+        if proxy and not urllib.request.proxy_bypass(host):
+            return parse_proxy(proxy)
+
+    def _new_connection(self, scheme, host):
+        proxy = self._get_proxy(scheme, host)
+        headers = {}
+        if proxy:
+            proxy_scheme, user, password, hostport = proxy
+            if user:
+                creds = base64.b64encode(('%s:%s' % (user, password or '')).encode('utf-8'))
+                headers['Proxy-Authorization'] = 'Basic ' + creds.decode('ascii')
+            connect_host = hostport
+        else:
+            connect_host = host
+
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(connect_host, timeout=self.timeout, context=self.ssl_context)
+            if proxy:
+                conn.set_tunnel(host, headers=headers)
+                headers = {}
+        else:
+            conn = http.client.HTTPConnection(connect_host, timeout=self.timeout)
+        # Plain HTTP through a proxy requests the absolute URL
+        conn.via_proxy = bool(proxy) and scheme == 'http'
+        conn.proxy_headers = headers
+        return conn
+
+    def _checkout(self, key):
+        now = time.time()
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                conn, last_used = connections.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._new_connection(*key), False
+
+    def _checkin(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append((conn, time.time()))
+
+    def request(self, url, data, headers, on_retry=None):
+        """POST data to url and return the response body.
+
+        on_retry is called each time a stale pooled connection is replaced.
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        while True:
+            conn, reused = self._checkout(key)
+            request_headers = dict(headers, **conn.proxy_headers)
+            try:
+                conn.request('POST', url if conn.via_proxy else path, data, request_headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if reused and not isinstance(e, socket.timeout):
+                    # The server dropped the connection while it sat in the pool
+                    logging.debug("Reconnecting stale connection to %s: %s", parts.netloc, e)
+                    if on_retry:
+                        on_retry()
+                    continue
+                raise urllib.error.URLError(e)
+            break
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+
+        if response.status != 200:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+        return body
+
+class RPCCall(object):
+    """Times one JSON API call; see RPCStats.call"""
+    def __init__(self, stats, method, sent):
+        self.stats = stats
+        self.method = method
+        self.sent = sent
+        self.received = 0
+        self.retries = 0
+
+    def retried(self):
+        self.retries += 1
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.record(self, time.time() - self.start, exc)
+        return False
+
+class RPCStats(object):
+    """Latency, traffic and error counts of JSON API calls, per method.
+
+    Errors are tallied by Pandora error code, or by exception class name
+    when there is no code (timeouts, network errors, invalid auth tokens).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def call(self, method, sent):
+        return RPCCall(self, method, sent)
+
+    def record(self, call, elapsed, error=None):
+        with self.lock:
+            m = self.methods.get(call.method)
+            if m is None:
+                m = self.methods[call.method] = {
+                    'calls': 0,
+                    'time_total': 0.0,
+                    'time_max': 0.0,
+                    'latency_ms': [0] * (len(RPC_LATENCY_BUCKETS) + 1),
+                    'bytes_sent': 0,
+                    'bytes_received': 0,
+                    'retries': 0,
+                    'errors': {},
+                }
+            m['calls'] += 1
+            m['time_total'] += elapsed
+            m['time_max'] = max(m['time_max'], elapsed)
+            ms = elapsed * 1000
+            bucket = next((i for i, bound in enumerate(RPC_LATENCY_BUCKETS) if ms <= bound), len(RPC_LATENCY_BUCKETS))
+            m['latency_ms'][bucket] += 1
+            m['bytes_sent'] += call.sent
+            m['bytes_received'] += call.received
+            m['retries'] += call.retries
+            if error is not None:
+                key = str(getattr(error, 'status', None) or type(error).__name__)
+                m['errors'][key] = m['errors'].get(key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            methods = json.loads(json.dumps(self.methods))
+        return {
+            'latency_buckets_ms': list(RPC_LATENCY_BUCKETS) + ['inf'],
+            'methods': methods,
+        }
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+class FeedbackQueue(object):
+    """Sends song ratings from a background thread.
+
+    rate() sets song.rating right away and sends the change FEEDBACK_DELAY
+    seconds later, so toggling a song several times in a row only sends the
+    final rating (or nothing, if it ends up where it started). Network
+    errors are retried; if the rating still can't be sent, song.rating is
+    restored and on_error(song, rating, error) is called from the queue's
+    thread.
+    """
+
+    def __init__(self, delay=FEEDBACK_DELAY, retries=FEEDBACK_RETRIES):
+        self.delay = delay
+        self.retries = retries
+        self.on_error = None
+        self.condition = threading.Condition()
+        self.pending = {}   # trackToken -> (song, time to send)
+        self.confirmed = {} # trackToken -> rating Pandora has for queued songs
+        self.sending = False
+        self.thread = None
+
+    def rate(self, song, rating):
+        with self.condition:
+            self.confirmed.setdefault(song.trackToken, song.rating)
+            self.pending[song.trackToken] = (song, time.time() + self.delay)
+            song.rating = rating
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def _next(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.pending:
+                    token, (song, due) = min(self.pending.items(), key=lambda item: item[1][1])
+                    if due <= now:
+                        del self.pending[token]
+                        self.sending = True
+                        return song, song.rating, self.confirmed[token]
+                    self.condition.wait(due - now)
+                else:
+                    self.condition.wait()
+
+    def _run(self):
+        while True:
+            song, rating, confirmed = self._next()
+            error = None
+            if rating != confirmed:
+                for attempt in range(self.retries):
+                    try:
+                        song.send_rating(rating, confirmed)
+                        error = None
+                        break
+                    except PandoraAuthTokenInvalid as e:
+                        error = e
+                        break
+                    except PandoraError as e:
+                        logging.warning("Sending rating failed (attempt %d): %s", attempt + 1, e.message)
+                        error = e
+                        if attempt + 1 < self.retries:
+                            time.sleep(2 ** attempt)
+                    except Exception as e:
+                        # Garbled response or a bug; don't let it take the
+                        # queue's thread down with it
+                        logging.error("Sending rating failed:\n%s", traceback.format_exc())
+                        error = e
+                        break
+
+            with self.condition:
+                if error is None:
+                    self.confirmed[song.trackToken] = rating
+                requeued = song.trackToken in self.pending
+                if not requeued:
+                    song.rating = self.confirmed.pop(song.trackToken)
+            if error is not None and not requeued and self.on_error:
+                try:
+                    self.on_error(song, rating, error)
+                except Exception:
+                    logging.error("Unhandled exception in rating error handler:\n%s", traceback.format_exc())
+            with self.condition:
+                self.sending = False
+                self.condition.notify_all()
+
+    def flush(self, timeout=FEEDBACK_FLUSH_TIMEOUT):
+        """Send queued ratings now rather than after the delay.
+
+        Waits up to timeout seconds for them to be sent; returns False if
+        some were still pending.
+        """
+        with self.condition:
+            for token, (song, due) in self.pending.items():
+                self.pending[token] = (song, 0)
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: not self.pending and not self.sending, timeout)
+
+class TitleResolver(object):
+    """Looks up song titles from the song explorer page in a background thread.
+
+    The name in the playlist is sometimes missing part of the title. Until
+    the real one is known Song.title is songName; resolve(song) queues the
+    lookup, and once song.title has changed on_resolved(song) is called from
+    the resolver's thread. Titles are saved to filename by explorer URL, so
+    each song is only looked up once.
+    """
+
+    def __init__(self, filename, max_entries=TITLE_CACHE_SIZE):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.on_resolved = None
+        self.condition = threading.Condition()
+        self.queue = {}   # explorer URL -> songs waiting for it
+        self.active = {}  # same, for the URL being fetched
+        self.failed = set()
+        self.thread = None
+        self.titles = self._load()
+
+    def get(self, url):
+        """The known title for an explorer URL, or None."""
+        with self.condition:
+            return self.titles.get(url)
+
+    def resolve(self, song):
+        url = song.songExplorerUrl
+        with self.condition:
+            if url in self.failed:
+                return
+            songs = self.active.get(url) or self.queue.setdefault(url, [])
+            if not any(s is song for s in songs):
+                songs.append(song)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                url = next(iter(self.queue))
+                songs = self.active[url] = self.queue.pop(url)
+
+            try:
+                title = songs[0].fetch_title()
+            except (OSError, http.client.HTTPException) as e:
+                logging.info("Could not look up title of %s: %s", songs[0].songName, e)
+                title = None
+            except Exception:
+                # A bad URL or a bug; the thread must keep going either way
+                logging.error("Looking up title of %s failed:\n%s", songs[0].songName, traceback.format_exc())
+                title = None
+
+            with self.condition:
+                del self.active[url]
+                if title is None:
+                    # Keep the name from the playlist rather than retrying
+                    self.failed.add(url)
+                else:
+                    self.titles[url] = title
+                    while len(self.titles) > self.max_entries:
+                        del self.titles[next(iter(self.titles))]
+                    titles = dict(self.titles)
+            if title is None:
+                for song in songs:
+                    song._title = song.songName
+                continue
+            self._save(titles)
+            for song in songs:
+                changed = title != song.songName
+                song._title = title
+                if changed and self.on_resolved:
+                    self.on_resolved(song)
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (IOError, ValueError) as e:
+            logging.warning("Discarding song title cache: %s", e)
+            return {}
+
+    def _save(self, titles):
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(titles, f)
+            os.replace(self.filename + '.tmp', self.filename)
+        except (IOError, OSError) as e:
+            logging.warning("Could not save song title cache: %s", e)
+
+class Services(object):
+    """The on-disk caches and background workers behind song downloads.
+
+    They own files under ~/Pithos, so there must only be one of each per
+    process however many clients there are; see shared_services().
+    """
     def __init__(self):
+        self.titles = TitleResolver(titles_file)
+        self.cache = AudioCache(cache_dir)
+        self.downloads = DownloadManager()
+        # Album art has its own thread so it never waits behind songs
+        self.art_downloads = DownloadManager(threads=1)
+        self.streams = StreamServer()
+        self.quality = QualitySelector()
+        self.library = Library(library_file, music_dir)
+
+_services = None
+_services_lock = threading.Lock()
+
+def shared_services():
+    """The Services used by every Pandora in this process, created on first use."""
+    global _services
+    with _services_lock:
+        if _services is None:
+            _services = Services()
+        return _services
+
+class Pandora(object):
+    def __init__(self, services=None):
         self.opener = urllib.request.build_opener()
-        pass
+        self.transport = HTTPConnectionPool(self.opener)
+        self.feedback = FeedbackQueue()
+        self.stats = RPCStats()
+        services = services or shared_services()
+        self.titles = services.titles
+        self.cache = services.cache
+        self.downloads = services.downloads
+        self.art_downloads = services.art_downloads
+        self.streams = services.streams
+        self.quality = services.quality
+        self.library = services.library
 
     def pandora_encrypt(self, s):
-        return b''.join([codecs.encode(self.blowfish_encode.encrypt(pad(s[i:i+8], 8)), 'hex_codec') for i in range(0, len(s), 8)])
+        return codecs.encode(self.blowfish_encode.encrypt(pad(s, -len(s) % 8 + len(s))), 'hex_codec')
 
     def pandora_decrypt(self, s):
-        return b''.join([self.blowfish_decode.decrypt(pad(codecs.decode(s[i:i+16], 'hex_codec'), 8)) for i in range(0, len(s), 16)]).rstrip(b'\x08')
+        s = codecs.decode(s, 'hex_codec')
+        return self.blowfish_decode.decrypt(pad(s, -len(s) % 8 + len(s))).rstrip(b'\x08')
 
     def json_call(self, method, args={}, https=False, blowfish=True):
+        url, data = self.build_request(method, args, https, blowfish)
+        with self.stats.call(method, len(data)) as call:
+            body = self.send_request(url, data, call)
+            call.received = len(body)
+            return self.parse_response(body)
+
+    def build_request(self, method, args, https, blowfish):
+        """Return the URL and (encrypted) body for a JSON API call."""
         url_arg_strings = []
         if self.partnerId:
             url_arg_strings.append('partner_id=%s'%self.partnerId)
@@ -96,6 +549,7 @@ class Pandora(object):
         protocol = 'https' if https else 'http'
         url = protocol + self.rpcUrl + '&'.join(url_arg_strings)
 
+        args = dict(args)
         if self.time_offset:
             args['syncTime'] = int(time.time()+self.time_offset)
         if self.userAuthToken:
@@ -104,29 +558,38 @@ class Pandora(object):
             args['partnerAuthToken'] = self.partnerAuthToken
         data = json.dumps(args).encode('utf-8')
 
-        logging.debug(url)
-        logging.debug(data)
+        if tracing():
+            logging.debug("%s %s", url, TracePayload(data))
 
         if blowfish:
             data = self.pandora_encrypt(data)
+        return url, data
 
+    def send_request(self, url, data, call=None):
+        """Post a request built by build_request and return the raw response body."""
         try:
-            req = urllib.request.Request(url, data, {'User-agent': USER_AGENT, 'Content-type': 'text/plain'})
-            response = self.opener.open(req, timeout=HTTP_TIMEOUT)
-            text = response.read().decode('utf-8')
+            body = self.transport.request(url, data, {'User-agent': USER_AGENT, 'Content-type': 'text/plain'},
+                                          call.retried if call else None)
         except urllib.error.HTTPError as e:
             logging.error("HTTP error: %s", e)
             raise PandoraNetError(str(e))
         except urllib.error.URLError as e:
             logging.error("Network error: %s", e)
-            if e.reason.strerror == 'timed out':
+            if isinstance(e.reason, socket.timeout) or getattr(e.reason, 'strerror', None) == 'timed out':
                 raise PandoraTimeout("Network error", submsg="Timeout")
             else:
-                raise PandoraNetError("Network error", submsg=e.reason.strerror)
+                raise PandoraNetError("Network error", submsg=getattr(e.reason, 'strerror', None) or str(e.reason))
+
+        return body
 
-        logging.debug(text)
+    def parse_response(self, body):
+        """Return the result of a JSON API response, raising PandoraError on failure."""
+        # Only formatted for the log when tracing is on
+        if tracing():
+            logging.debug("%s", TracePayload(body))
 
-        tree = json.loads(text)
+        # The raw bytes go straight to json rather than being decoded first
+        tree = json.loads(body)
 
         if tree['stat'] == 'fail':
             code = tree['code']
@@ -160,16 +623,31 @@ class Pandora(object):
             else:
                 raise PandoraError("Pandora returned an error", code, "%s (code %d)"%(msg, code))
 
-        if 'result' in tree:
-            return tree['result']
+        return tree.get('result')
 
     def set_audio_quality(self, fmt):
         self.audio_quality = fmt
 
+    def set_cache_size(self, max_bytes):
+        self.cache.set_max_bytes(max_bytes)
+
     def set_url_opener(self, opener):
         self.opener = opener
+        self.transport.set_opener(opener)
 
     def connect(self, client, user, password):
+        self.set_client(client)
+
+        partner = self.json_call('auth.partnerLogin', partner_login_args(client), https=True, blowfish=False)
+        self.set_partner(partner)
+
+        user = self.json_call('auth.userLogin', {'username': user, 'password': password, 'loginType': 'user'}, https=True)
+        self.userId = user['userId']
+        self.userAuthToken = user['userAuthToken']
+
+        self.get_stations(self)
+
+    def set_client(self, client):
         self.partnerId = self.userId = self.partnerAuthToken = None
         self.userAuthToken = self.time_offset = None
 
@@ -177,13 +655,7 @@ class Pandora(object):
         self.blowfish_encode = Blowfish(client['encryptKey'].encode('utf-8'))
         self.blowfish_decode = Blowfish(client['decryptKey'].encode('utf-8'))
 
-        partner = self.json_call('auth.partnerLogin', {
-            'deviceModel': client['deviceModel'],
-            'username': client['username'], # partner username
-            'password': client['password'], # partner password
-            'version': client['version']
-            },https=True, blowfish=False)
-
+    def set_partner(self, partner):
         self.partnerId = partner['partnerId']
         self.partnerAuthToken = partner['partnerAuthToken']
 
@@ -191,16 +663,15 @@ class Pandora(object):
         self.time_offset = pandora_time - time.time()
         logging.info("Time offset is %s", self.time_offset)
 
-        user = self.json_call('auth.userLogin', {'username': user, 'password': password, 'loginType': 'user'}, https=True)
-        self.userId = user['userId']
-        self.userAuthToken = user['userAuthToken']
+    def get_stations(self, *ignore):
+        self.load_stations(self.json_call('user.getStationList')['stations'])
 
-        self.get_stations(self)
+    def make_station(self, d):
+        return Station(self, d)
 
-    def get_stations(self, *ignore):
-        stations = self.json_call('user.getStationList')['stations']
+    def load_stations(self, stations):
         self.quickMixStationIds = None
-        self.stations = [Station(self, i) for i in stations]
+        self.stations = [self.make_station(i) for i in stations]
 
         if self.quickMixStationIds:
             for i in self.stations:
@@ -215,8 +686,9 @@ class Pandora(object):
         self.json_call('user.setQuickMix', {'quickMixStationIds': stationIds})
 
     def search(self, query):
-        results = self.json_call('music.search', {'searchText': query})
+        return self.sort_search_results(self.json_call('music.search', {'searchText': query}))
 
+    def sort_search_results(self, results):
         l =  [SearchResult('artist', i) for i in results['artists']]
         l += [SearchResult('song',   i) for i in results['songs']]
         l.sort(key=lambda i: i.score, reverse=True)
@@ -225,7 +697,7 @@ class Pandora(object):
 
     def add_station_by_music_id(self, musicid):
         d = self.json_call('station.createStation', {'musicToken': musicid})
-        station = Station(self, d)
+        station = self.make_station(d)
         self.stations.append(station)
         return station
 
@@ -244,10 +716,12 @@ class Pandora(object):
         self.json_call('station.deleteFeedback', {'feedbackId': feedbackId, 'stationToken': stationToken})
 
 class Station(object):
+    __slots__ = ('pandora', 'id', 'idToken', 'isCreator', 'isQuickMix', 'name', 'useQuickMix')
+
     def __init__(self, pandora, d):
         self.pandora = pandora
 
-        self.id = d['stationId']
+        self.id = sys.intern(d['stationId'])
         self.idToken = d['stationToken']
         self.isCreator = not d['isShared']
         self.isQuickMix = d['isQuickMix']
@@ -266,11 +740,17 @@ class Station(object):
     def get_playlist(self):
         logging.info("pandora: Get Playlist")
         playlist = self.pandora.json_call('station.getPlaylist', {'stationToken': self.idToken}, https=True)
+        return self.load_playlist(playlist)
+
+    def make_song(self, d):
+        return Song(self.pandora, d)
+
+    def load_playlist(self, playlist):
         songs = []
         for i in playlist['items']:
             if 'songName' in i: # check for ads
                 i['stationName'] = self.name
-                songs.append(Song(self.pandora, i))
+                songs.append(self.make_song(i))
         return songs
 
     @property
@@ -289,25 +769,40 @@ class Station(object):
         self.pandora.json_call('station.deleteStation', {'stationToken': self.idToken})
 
 downloads = {}
-temp_dir = os.path.join(os.path.expanduser('~'),'Pithos','Temp')
+cache_dir = os.path.join(os.path.expanduser('~'),'Pithos','Cache')
 music_dir = os.path.join(os.path.expanduser('~'),'Pithos','Music')
+library_file = os.path.join(os.path.expanduser('~'),'Pithos','library.sqlite')
+titles_file = os.path.join(os.path.expanduser('~'),'Pithos','titles.json')
 class Song(object):
+    # Songs pile up in the history, so no per-instance __dict__. Strings
+    # shared by many songs (station, artist, album, art) are interned, and
+    # of the playlist's audioUrlMap only the URL we download is kept.
+    __slots__ = (
+        'pandora', 'album', 'artist', 'audio_quality', 'audio_url', 'trackToken', 'rating',
+        'stationId', 'songName', 'songDetailURL', 'songExplorerUrl', 'artRadio', 'stationName',
+        'index', 'bitrate', 'duration', 'is_ad', 'tired', 'message', 'start_time', 'finished',
+        'playlist_time', 'position', 'feedbackId', 'downloaded', 'file_name', 'art_name', 'art_pixbuf',
+        'markup', 'download_priority', 'audio_download', 'art_download', '_title',
+    )
+
     def __init__(self, pandora, d):
         self.pandora = pandora
 
-        self.album = d['albumName']
-        self.artist = d['artistName']
-        self.audioUrlMap = d['audioUrlMap']
+        self.album = sys.intern(d['albumName'])
+        self.artist = sys.intern(d['artistName'])
+        self.audio_quality, self.audio_url, self.bitrate = self.select_quality(d['audioUrlMap'])
         self.trackToken = d['trackToken']
         self.rating = RATE_LOVE if d['songRating'] == 1 else RATE_NONE # banned songs won't play, so we don't care about them
-        self.stationId = d['stationId']
+        self.stationId = sys.intern(d['stationId'])
         self.songName = d['songName']
         self.songDetailURL = d['songDetailUrl']
         self.songExplorerUrl = d['songExplorerUrl']
-        self.artRadio = d['albumArtUrl']
-        self.stationName = d['stationName']
+        self.artRadio = sys.intern(d['albumArtUrl']) if d['albumArtUrl'] else d['albumArtUrl']
+        self.stationName = sys.intern(d['stationName'])
 
-        self.bitrate = None
+        self.index = None # position in the UI's song list, if it is in it
+        self.duration = None
+        self.position = None
         self.is_ad = None  # None = we haven't checked, otherwise True/False
         self.tired=False
         self.message=''
@@ -317,18 +812,31 @@ class Song(object):
         self.feedbackId = None
 
         self.downloaded = False
+        self.file_name = None
+        self.art_name = None
+        self.art_pixbuf = None
+        self.markup = None # (what it was made from, markup), kept by the UI
+        self.download_priority = PRIORITY_LOW
+        self.audio_download = None
+        self.art_download = None
         self.download()
 
-    def get_download_url(self):
+    def select_quality(self, audioUrlMap):
+        """Returns the quality to use, its URL and its bitrate (if known) in bit/s."""
         quality = self.pandora.audio_quality
-        try:
-            q = self.audioUrlMap[quality]
-        except KeyError:
-            logging.warn("Unable to use audio format %s. Using %s", quality, list(self.audioUrlMap.keys())[0])
-            q = list(self.audioUrlMap.values())[0]['audioUrl']
-        logging.info("Using audio quality %s: %s %s", quality, q['bitrate'], q['encoding'])
-        audiourl = q['audioUrl']
-        return audiourl
+        if quality == AUTOMATIC_QUALITY:
+            quality = self.pandora.quality.choose(audioUrlMap)
+        elif quality not in audioUrlMap:
+            fallback = next(iter(audioUrlMap))
+            logging.warn("Unable to use audio format %s. Using %s", quality, fallback)
+            quality = fallback
+        q = audioUrlMap[quality]
+        logging.info("Using audio quality %s: %s %s", quality, q.get('bitrate'), q.get('encoding'))
+        bitrate = int(q['bitrate']) * 1000 if q.get('bitrate') else None
+        return quality, q['audioUrl'], bitrate
+
+    def get_download_url(self):
+        return self.audio_url
 
     def resolve_filename(self):
         return os.path.join(self.get_folders_path(), self.get_song_filename())
@@ -351,10 +859,6 @@ class Song(object):
         album_dir = self.get_album_folder()
         return os.path.join(station_dir, artist_dir, album_dir)
 
-    def get_temp_dir(self):
-        global temp_dir
-        return temp_dir
-
     def get_music_dir(self):
         global music_dir
         return music_dir
@@ -362,58 +866,120 @@ class Song(object):
     def get_stored_filename(self):
         return os.path.join(self.get_music_dir(), self.resolve_filename())
 
-    def get_temp_filename(self):
-        return os.path.join(self.get_temp_dir(), self.resolve_filename())
+    @property
+    def cache_name(self):
+        return cache_key(self.artist, self.album, self.songName, self.audio_quality) + '.mp4'
+
+    @property
+    def art_cache_name(self):
+        return cache_key(self.artRadio) + '.jpg' if self.artRadio else None
 
     def is_stored(self):
-        return os.path.exists(self.get_stored_filename())
+        return self.pandora.library.lookup(self.resolve_filename()) is not None
 
     def download(self):
         # If stored, return stored filename
-        stored_filename = self.get_stored_filename()
-        if os.path.isfile(stored_filename):
-            self.file_name = stored_filename
-            self.downloaded = True
-            return
-        # Create required folders if not already created
-        folders_path = os.path.join(self.get_temp_dir(),self.get_folders_path())
-        if not os.path.exists(folders_path):
-            os.makedirs(folders_path)
-        # Get URL to download from
-        audiourl = self.get_download_url()
-        arturl = self.artRadio
-        # Get the temp file path
-        temp_filename = self.get_temp_filename()
-        temp_art_file = os.path.join(folders_path, 'cover_art.jpg')
-        # Download song in seperate process
-        def runInThread():
-            try:
-                if arturl:
-                    album_art, headers = urllib.request.urlretrieve(arturl, temp_art_file)
-                else:
-                    print("No album art found for " + os.path.join(self.get_folders_path(), self.get_song_filename()))
-                tmp_filename, headers = urllib.request.urlretrieve(audiourl, temp_filename, reporthook=self.dlProgress)
-            except Exception:
-                import traceback
-                print(traceback.format_exc())
-                print('Download Failed\n')
-                self.art_name = None
-                self.file_name = None
+        if self.is_stored():
+            stored_filename = self.get_stored_filename()
+            if os.path.isfile(stored_filename):
+                self.file_name = stored_filename
+                self.downloaded = True
+                stored_art = os.path.join(os.path.dirname(stored_filename), 'cover_art.jpg')
+                if os.path.isfile(stored_art):
+                    self.art_name = stored_art
+                    return
             else:
-                if arturl:
-                    self.art_name = album_art
-                self.file_name = tmp_filename
+                # Deleted behind our back
+                self.pandora.library.remove(self.resolve_filename())
+        cache = self.pandora.cache
+        audio_name = self.cache_name
+        art_name = self.art_cache_name
+        cached_art = cache.lookup(art_name) if art_name else None
+        if cached_art:
+            self.art_name = cached_art
+        if not self.downloaded:
+            cached_audio = cache.lookup(audio_name)
+            if cached_audio:
+                self.file_name = cached_audio
+                self.downloaded = True
+        if self.downloaded and (not art_name or cached_art):
             return
-        thread = threading.Thread(target=runInThread)
-        thread.start()
+        # The download manager only moves files into place once complete,
+        # so a cache entry is never partial.
+        def fetch(manager, name, url, priority, on_done, reporthook=None):
+            cache.prepare(name)
+            def callback(download):
+                cache.add(name)
+                on_done(cache.path(name))
+            def errorback(download, error):
+                print(error.traceback)
+                print('Download Failed\n')
+            return manager.fetch(url, cache.path(name), priority, callback, errorback, reporthook)
+        if not art_name:
+            print("No album art found for " + os.path.join(self.get_folders_path(), self.get_song_filename()))
+        elif not cached_art:
+            def art_done(path):
+                self.art_name = path
+            # The UI waits on art, so it is fetched by its own download
+            # thread rather than queueing behind songs' audio
+            self.art_download = fetch(self.pandora.art_downloads, art_name, self.artRadio,
+                                      min(self.download_priority, PRIORITY_DEFAULT), art_done)
+        if not self.downloaded:
+            def audio_done(path):
+                self.file_name = path
+                self.downloaded = True
+                download = self.audio_download
+                if download and self.pandora.audio_quality == AUTOMATIC_QUALITY:
+                    self.pandora.quality.add_sample(download.transferred, download.shared_seconds)
+                print('Finished Downloading %s' % self.resolve_filename())
+            self.audio_download = fetch(self.pandora.downloads, audio_name, self.get_download_url(),
+                                        self.download_priority, audio_done, reporthook=self.dlProgress)
+
+    def set_download_priority(self, priority):
+        """Move this song's pending downloads up or down the queue."""
+        self.download_priority = priority
+        if self.audio_download:
+            self.audio_download.set_priority(priority)
+        if self.art_download:
+            self.art_download.set_priority(min(priority, PRIORITY_DEFAULT))
+
+    def cancel_download(self):
+        # Album art is small and may be shared with other songs, so leave it
+        if self.audio_download:
+            self.audio_download.cancel()
+
+    def get_art_file(self, timeout=None):
+        """Local path of the album art, waiting for it to download if needed."""
+        if self.art_name:
+            return self.art_name
+        download = self.art_download
+        if download and download.wait(timeout) and download.state == DONE:
+            # art_name is set by a callback that may not have run yet
+            return download.filename
+        return None
+
+    @property
+    def art_url(self):
+        """URL of the album art, local if it has been downloaded."""
+        if self.art_name:
+            return 'file://' + self.art_name
+        return self.artRadio
+
+    @property
+    def download_progress(self):
+        """Fraction of the audio downloaded, or None if unknown."""
+        if self.downloaded:
+            return 1.0
+        if self.audio_download:
+            return self.audio_download.progress
 
     def dlProgress(self, count, blockSize, totalSize):
+        if totalSize <= 0:
+            return
         percent = int(count*blockSize*100/totalSize)
         global downloads
         if percent >= 100:
-            self.downloaded = True
             downloads.pop(self.songName, None)
-            print('Finished Downloading %s' % self.resolve_filename())
         else:
             downloads[self.songName] = percent
         dl_strings = []
@@ -425,42 +991,35 @@ class Song(object):
         sys.stdout.write('\x1b[2K')
 
     def delete_temp(self):
-        # Delete the file
-        file_name = self.get_temp_filename()
-        art_name = os.path.join(self.get_temp_dir(), self.get_folders_path(), 'cover_art.jpg')
-        if os.path.isfile(file_name):
-            os.remove(file_name)
-        if os.path.isfile(art_name):
-            os.remove(art_name)
-        # Delete the album folder if empty
-        album_folder = os.path.join(self.get_temp_dir(), self.get_station_folder(), self.get_artist_folder(), self.get_album_folder())
-        if os.path.exists(album_folder):
-            if not os.listdir(album_folder):
-                os.rmdir(album_folder)
-        # Delete the artist folder if empty
-        artist_folder = os.path.join(self.get_temp_dir(), self.get_station_folder(), self.get_artist_folder())
-        if os.path.exists(artist_folder):
-            if not os.listdir(artist_folder):
-                os.rmdir(artist_folder)
-        # Delete the station folder if empty
-        station_folder = os.path.join(self.get_temp_dir(), self.get_station_folder())
-        if os.path.exists(station_folder):
-            if not os.listdir(station_folder):
-                os.rmdir(station_folder)
+        # Drop the audio from the cache (used for ads, which we never want
+        # to replay). Album art is shared between songs so it stays. Stored
+        # songs are left alone, so the library needs no update.
+        if not self.is_stored():
+            self.cancel_download()
+            self.pandora.cache.remove(self.cache_name)
 
     def store(self):
-        # Move from temp to music
+        cache = self.pandora.cache
+        if not self.is_stored() and not os.path.isfile(cache.path(self.cache_name)):
+            # Still downloading; store it once it has arrived
+            if self.audio_download and self.audio_download.add_callback(lambda download: self.store()):
+                return
+            logging.warning("Cannot store %s, it was not downloaded", self.resolve_filename())
+            return
+        # Hard link from the cache into music; only across filesystems is
+        # anything copied. The cached copy stays, since other songs (the
+        # same track on another station, or a stream still being read)
+        # may be using it.
         stored_dirs = os.path.join(self.get_music_dir(), self.get_folders_path())
-        if not os.path.exists(stored_dirs):
-            os.makedirs(stored_dirs)
+        os.makedirs(stored_dirs, exist_ok=True)
         if not os.path.isfile(self.get_stored_filename()):
-            shutil.copy(self.get_temp_filename(), self.get_stored_filename())
-        tmp_art_name = os.path.join(self.get_temp_dir(), self.get_folders_path(), 'cover_art.jpg')
-        stored_art_name = os.path.join(self.get_music_dir(), self.get_folders_path(), 'cover_art.jpg')
-        if not os.path.isfile(stored_art_name) and os.path.isfile(tmp_art_name):
-            shutil.copy(tmp_art_name, stored_art_name)
+            cache.link_out(self.cache_name, self.get_stored_filename())
+        self.pandora.library.add(self.resolve_filename(), self.trackToken, self.stationName, self.artist,
+                                 self.album, self.songName, self.duration, self.bitrate)
+        stored_art_name = os.path.join(stored_dirs, 'cover_art.jpg')
+        if self.art_cache_name and not os.path.isfile(stored_art_name):
+            cache.link_out(self.art_cache_name, stored_art_name)
         self.file_name = self.get_stored_filename()
-        self.delete_temp()
 
     def make_safe(self, filename):
         valid_chars = "&+-_.() %s%s" % (string.ascii_letters, string.digits)
@@ -478,23 +1037,41 @@ class Song(object):
             if clean_name == clean_expl_name:
                 self._title = self.songName
             else:
-                try:
-                    xml_data = urllib.urlopen(self.songExplorerUrl)
-                    dom = minidom.parseString(xml_data.read())
-                    attr_value = dom.getElementsByTagName('songExplorer')[0].attributes['songTitle'].value
-
-                    # Pandora stores their titles for film scores and the like as 'Score name: song name'
-                    self._title = attr_value.replace('{0}: '.format(self.songName), '', 1)
-                except:
-                    self._title = self.songName
+                title = self.pandora.titles.get(self.songExplorerUrl)
+                if title is None:
+                    # Never block the caller on the network; see TitleResolver
+                    self.pandora.titles.resolve(self)
+                    return self.songName
+                self._title = title
         return self._title
 
+    def fetch_title(self):
+        """Download the title from the song explorer page."""
+        with self.pandora.opener.open(self.songExplorerUrl, timeout=HTTP_TIMEOUT) as response:
+            data = response.read()
+        try:
+            dom = minidom.parseString(data)
+            attr_value = dom.getElementsByTagName('songExplorer')[0].attributes['songTitle'].value
+        except (ExpatError, IndexError, KeyError):
+            logging.info("No title on song explorer page for %s", self.songName)
+            return self.songName
+
+        # Pandora stores their titles for film scores and the like as 'Score name: song name'
+        return attr_value.replace('{0}: '.format(self.songName), '', 1)
+
     @property
     def audioUrl(self):
-        import time
-        while not self.downloaded:
-            time.sleep(1)
-        return 'file://'+self.file_name
+        if self.downloaded:
+            return 'file://'+self.file_name
+        if not self.audio_download or self.audio_download.state in (CANCELLED, FAILED):
+            # Skipped over by a station change but wanted after all, or
+            # failed earlier; try again.
+            self.download_priority = PRIORITY_HIGH
+            self.download()
+            if self.downloaded:
+                return 'file://'+self.file_name
+        # Play while downloading, without waiting for the whole file
+        return self.pandora.streams.url_for(self.audio_download)
 
     @property
     def station(self):
@@ -502,20 +1079,27 @@ class Song(object):
 
     def rate(self, rating):
         if self.rating != rating:
-            self.station.transformIfShared()
-            if rating == RATE_NONE:
-                if not self.feedbackId:
-                    # We need a feedbackId, get one by re-rating the song. We
-                    # could also get one by calling station.getStation, but
-                    # that requires transferring a lot of data (all feedback,
-                    # seeds, etc for the station).
-                    opposite = RATE_BAN if self.rating == RATE_LOVE else RATE_LOVE
-                    self.feedbackId = self.pandora.add_feedback(self.trackToken, opposite)
-                self.pandora.delete_feedback(self.station.idToken, self.feedbackId)
-            else:
-                self.feedbackId = self.pandora.add_feedback(self.trackToken, rating)
+            self.send_rating(rating, self.rating)
             self.rating = rating
 
+    def queue_rating(self, rating):
+        """Rate the song right away and send it to Pandora in the background."""
+        self.pandora.feedback.rate(self, rating)
+
+    def send_rating(self, rating, old_rating):
+        self.station.transformIfShared()
+        if rating == RATE_NONE:
+            if not self.feedbackId:
+                # We need a feedbackId, get one by re-rating the song. We
+                # could also get one by calling station.getStation, but
+                # that requires transferring a lot of data (all feedback,
+                # seeds, etc for the station).
+                opposite = RATE_BAN if old_rating == RATE_LOVE else RATE_LOVE
+                self.feedbackId = self.pandora.add_feedback(self.trackToken, opposite)
+            self.pandora.delete_feedback(self.station.idToken, self.feedbackId)
+        else:
+            self.feedbackId = self.pandora.add_feedback(self.trackToken, rating)
+
     def set_tired(self):
         if not self.tired:
             self.pandora.json_call('user.sleepSong', {'trackToken': self.trackToken})
@@ -535,6 +1119,8 @@ class Song(object):
         return (time.time() - self.playlist_time) < PLAYLIST_VALIDITY_TIME
 
 class SearchResult(object):
+    __slots__ = ('resultType', 'score', 'musicId', 'title', 'artist', 'name')
+
     def __init__(self, resultType, d):
         self.resultType = resultType
         self.score = d['score']
@@ -546,3 +1132,38 @@ class SearchResult(object):
         elif resultType == 'artist':
             self.name = d['artistName']
 
+
+if __name__ == '__main__':
+    # Memory held by a long song history: python3 -m pithos.pandora.pandora [count]
+    import gc
+    import tracemalloc
+
+    class BenchPandora(object):
+        audio_quality = 'highQuality'
+
+    class BenchSong(Song):
+        __slots__ = ()
+        def download(self):
+            pass
+
+    def playlist_item(i):
+        url = 'http://audio.example.com/access/%d.mp4?version=4&token=%s' % (i, 'x' * 400)
+        return {
+            'albumName': 'Album %d' % (i // 12), 'artistName': 'Artist %d' % (i // 40),
+            'audioUrlMap': {q: {'audioUrl': url + q, 'bitrate': '64', 'encoding': 'aacplus', 'protocol': 'http'}
+                            for q in ('highQuality', 'mediumQuality', 'lowQuality')},
+            'trackToken': 'T%040d' % i, 'songRating': 0, 'stationId': '1234567890',
+            'songName': 'Song %d' % i, 'songDetailUrl': 'http://www.pandora.com/song/%d' % i,
+            'songExplorerUrl': 'http://www.pandora.com/xml/music/track/%d' % i,
+            'albumArtUrl': 'http://cont.example.com/images/%d.jpg' % (i // 12), 'stationName': 'Test Radio',
+        }
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    pandora = BenchPandora()
+    gc.collect()
+    tracemalloc.start()
+    songs = [BenchSong(pandora, playlist_item(i)) for i in range(count)]
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%d songs: %.1f MB, %d bytes per song' % (count, size / 1024**2, size // count))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+### BEGIN LICENSE
+#This program is free software: you can redistribute it and/or modify it
+#under the terms of the GNU General Public License version 3, as published
+#by the Free Software Foundation.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranties of
+#MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#PURPOSE.  See the GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+# Picks the audio quality for each song from how fast songs have actually
+# been downloading, for the "Automatic" audio quality preference.
+#
+# Each finished song download gives a throughput sample, averaged into an
+# estimate. The quality only goes down when the estimate gets close to what
+# the current quality needs, and only goes up once it is comfortably above
+# what the next one needs and nothing has gone wrong for a while, so it
+# does not flip back and forth between songs. Playback stopping to buffer
+# in the middle of a song drops it one step straight away.
+
+import logging
+import threading
+import time
+
+AUTOMATIC_QUALITY = 'automatic'
+
+# Lowest first
+QUALITY_LEVELS = ('lowQuality', 'mediumQuality', 'highQuality')
+# kbit/s, for playlists that do not say
+QUALITY_BITRATES = {'lowQuality': 32, 'mediumQuality': 64, 'highQuality': 192}
+
+DOWN_MARGIN = 1.5    # step down below this many times the current bitrate
+UP_MARGIN = 3.0      # step up above this many times the next bitrate
+HOLD_TIME = 60       # seconds after a change before stepping up again
+STALL_HOLD_TIME = 600 # seconds after buffering before stepping up again
+SAMPLE_WEIGHT = 0.3  # of each new sample in the estimate
+MIN_SAMPLE_BYTES = 256 * 1024 # smaller downloads mostly measure latency
+
+class QualitySelector(object):
+    def __init__(self, level='mediumQuality'):
+        self.lock = threading.Lock()
+        self.level = QUALITY_LEVELS.index(level)
+        self.bitrates = dict(QUALITY_BITRATES)
+        self.throughput = None # kbit/s
+        self.samples = 0
+        self.stalls = 0
+        self.last_change = 0
+        self.last_stall = 0
+
+    def choose(self, audioUrlMap):
+        """The quality to download from audioUrlMap."""
+        with self.lock:
+            for quality in QUALITY_LEVELS:
+                bitrate = audioUrlMap.get(quality, {}).get('bitrate')
+                if bitrate:
+                    self.bitrates[quality] = int(bitrate)
+            # The best one we are allowed that this song has, or failing
+            # that the worst one it has
+            for quality in reversed(QUALITY_LEVELS[:self.level + 1]):
+                if quality in audioUrlMap:
+                    return quality
+            for quality in QUALITY_LEVELS:
+                if quality in audioUrlMap:
+                    return quality
+            return next(iter(audioUrlMap))
+
+    def add_sample(self, nbytes, seconds):
+        """Record a download of nbytes that took seconds."""
+        if nbytes < MIN_SAMPLE_BYTES or seconds <= 0:
+            return
+        kbps = nbytes * 8 / 1000 / seconds
+        with self.lock:
+            if self.throughput is None:
+                self.throughput = kbps
+            else:
+                self.throughput += SAMPLE_WEIGHT * (kbps - self.throughput)
+            self.samples += 1
+
+            now = time.time()
+            current = self.bitrates[QUALITY_LEVELS[self.level]]
+            if self.level > 0 and self.throughput < current * DOWN_MARGIN:
+                self._set_level(self.level - 1, now)
+            elif (self.level + 1 < len(QUALITY_LEVELS)
+                  and now - self.last_change >= HOLD_TIME
+                  and now - self.last_stall >= STALL_HOLD_TIME
+                  and self.throughput > self.bitrates[QUALITY_LEVELS[self.level + 1]] * UP_MARGIN):
+                self._set_level(self.level + 1, now)
+
+    def stalled(self):
+        """Playback had to stop and wait for the download."""
+        with self.lock:
+            now = time.time()
+            self.stalls += 1
+            self.last_stall = now
+            if self.level > 0:
+                self._set_level(self.level - 1, now)
+
+    def _set_level(self, level, now):
+        logging.info("Audio quality %s -> %s (%s kbit/s measured)", QUALITY_LEVELS[self.level],
+                     QUALITY_LEVELS[level], '%d' % self.throughput if self.throughput is not None else 'nothing')
+        self.level = level
+        self.last_change = now
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'quality': QUALITY_LEVELS[self.level],
+                'throughput_kbps': self.throughput,
+                'samples': self.samples,
+                'stalls': self.stalls,
+            }
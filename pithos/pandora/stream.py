@@ -0,0 +1,156 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+### BEGIN LICENSE
+#This program is free software: you can redistribute it and/or modify it
+#under the terms of the GNU General Public License version 3, as published
+#by the Free Software Foundation.
+#
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranties of
+#MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#PURPOSE.  See the GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program.  If not, see <http://www.gnu.org/licenses/>.
+### END LICENSE
+
+# Lets playback start before a song has finished downloading. Songs that are
+# still being written to the cache are served to GStreamer over HTTP on the
+# loopback interface, straight from the growing .part file. The song is
+# only fetched from Pandora once: the download manager writes it to disk and
+# this server follows along behind it.
+
+import http.server
+import logging
+import re
+import threading
+import time
+import uuid
+
+from .download import DONE
+
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_WAIT = 30       # seconds without new data before giving up
+STREAM_MAX_ENTRIES = 32
+RANGE_REGEX = re.compile(r'bytes=(\d+)-')
+
+class StreamEntry(object):
+    def __init__(self, download, content_type):
+        self.download = download
+        self.content_type = content_type
+
+    def open(self):
+        """Open the file being downloaded, wherever it is right now."""
+        for attempt in range(10):
+            # Once complete the .part file is renamed to its final name
+            for filename in (self.download.part_filename, self.download.filename):
+                try:
+                    return open(filename, 'rb')
+                except FileNotFoundError:
+                    pass
+            time.sleep(0.1)
+        raise FileNotFoundError(self.download.filename)
+
+class StreamHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug("stream: " + format, *args)
+
+    def do_GET(self):
+        entry = self.server.entries.get(self.path.lstrip('/'))
+        if entry is None:
+            self.send_error(404)
+            return
+        download = entry.download
+
+        # Wait for the response headers from Pandora so we know the length
+        download.wait_for_data(0, STREAM_WAIT)
+        if not download.received and download.state != DONE:
+            self.send_error(503)
+            return
+        total = download.received if download.state == DONE else download.total
+
+        start = 0
+        match = RANGE_REGEX.match(self.headers.get('Range', ''))
+        if match and total:
+            start = int(match.group(1))
+            if start >= total:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, total - 1, total))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', entry.content_type)
+        self.send_header('Accept-Ranges', 'bytes')
+        if total:
+            self.send_header('Content-Length', str(total - start))
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+        try:
+            with entry.open() as f:
+                self.stream_file(f, download, start)
+        except OSError as e:
+            # GStreamer closes the connection when it seeks or stops
+            logging.debug("stream: %s closed: %s", self.path, e)
+            self.close_connection = True
+
+    def stream_file(self, f, download, offset):
+        f.seek(offset)
+        while True:
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if chunk:
+                self.wfile.write(chunk)
+                offset += len(chunk)
+                continue
+            if download.finished.is_set():
+                if download.state == DONE and offset < download.received:
+                    continue
+                if download.state != DONE:
+                    # Failed or cancelled; cut the stream short so the
+                    # player reports an error instead of a short song
+                    self.close_connection = True
+                break
+            if not download.wait_for_data(offset, STREAM_WAIT):
+                logging.warning("stream: no data for %s in %d seconds", self.path, STREAM_WAIT)
+                self.close_connection = True
+                break
+
+class StreamServer(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.entries = {}
+
+    def _start(self):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StreamHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.entries = self.entries
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info("Streaming server listening on port %d", self.httpd.server_port)
+
+    def url_for(self, download, content_type='audio/mp4'):
+        """URL to play download from while it is being written."""
+        with self.lock:
+            if self.httpd is None:
+                self._start()
+            for token, entry in list(self.entries.items()):
+                if entry.download.finished.is_set() and entry.download.state != DONE:
+                    del self.entries[token]
+            while len(self.entries) >= STREAM_MAX_ENTRIES:
+                del self.entries[next(iter(self.entries))]
+            token = uuid.uuid4().hex
+            self.entries[token] = StreamEntry(download, content_type)
+        return 'http://127.0.0.1:%d/%s' % (self.httpd.server_port, token)
+
+    def close(self):
+        with self.lock:
+            if self.httpd is not None:
+                self.httpd.shutdown()
+                self.httpd.server_close()
+                self.httpd = None
@@ -20,11 +20,11 @@ import re
 import os, time
 import logging, argparse
 import signal
+import threading
 
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GObject, Gtk, Gdk, Pango, GdkPixbuf, Gio, GLib
-import contextlib
 import html
 import math
 import urllib.request, urllib.error, urllib.parse
@@ -46,15 +46,17 @@ else:
 sys.path.insert(0, os.path.dirname(fullPath))
 
 from . import AboutPithosDialog, PreferencesPithosDialog, StationsDialog
-from .util import parse_proxy, open_browser
+from .util import parse_proxy, open_browser, tracing
 from .pithosconfig import get_ui_file, get_media_file, VERSION
-from .gobject_worker import GObjectWorker
+from .gobject_worker import GObjectWorker, PRIORITY_HIGH, PRIORITY_DEFAULT, PRIORITY_LOW
+from .album_art import pixbuf_cache
 from .plugin import load_plugins
 if sys.platform != 'win32':
     from .dbus_service import PithosDBusProxy
     from .mpris import PithosMprisService
 from .pandora import *
 from .pandora.data import *
+from .pandora.blowfish import set_schedule_cache_file
 
 pacparser_imported = False
 try:
@@ -75,6 +77,7 @@ def buttonMenu(button, menu):
 
 ALBUM_ART_SIZE = 96
 ALBUM_ART_X_PAD = 6
+ALBUM_ART_TIMEOUT = 60 # seconds an art worker thread waits for a download
 
 class CellRendererAlbumArt(Gtk.CellRenderer):
     def __init__(self):
@@ -82,6 +85,10 @@ class CellRendererAlbumArt(Gtk.CellRenderer):
         self.icon = None
         self.pixbuf = None
         self.rate_bg = GdkPixbuf.Pixbuf.new_from_file(get_media_file('rate'))
+        # Rating badge (background plus icon) for each icon, drawn once
+        # rather than on every redraw of every row
+        self.overlays = {}
+        Gtk.Settings.get_default().connect('notify::gtk-icon-theme-name', lambda *ignore: self.overlays.clear())
 
     __gproperties__ = {
         'icon': (str, 'icon', 'icon', '', GObject.PARAM_READWRITE),
@@ -94,35 +101,67 @@ class CellRendererAlbumArt(Gtk.CellRenderer):
         return getattr(self, pspec.name)
     def do_get_size(self, widget, cell_area):
         return (0, 0, ALBUM_ART_SIZE + ALBUM_ART_X_PAD, ALBUM_ART_SIZE)
+
+    def get_overlay(self, widget, icon_name):
+        overlay = self.overlays.get(icon_name)
+        if overlay is None:
+            icon = widget.get_style_context().lookup_icon_set(icon_name)
+            pixbuf = icon.render_icon_pixbuf(widget.get_style_context(), Gtk.IconSize.MENU)
+            overlay = self.rate_bg.copy()
+            x = max(self.rate_bg.get_width() - pixbuf.get_width() - 5, 0)
+            y = max(self.rate_bg.get_height() - pixbuf.get_height() - 5, 0)
+            width = min(pixbuf.get_width(), overlay.get_width() - x)
+            height = min(pixbuf.get_height(), overlay.get_height() - y)
+            pixbuf.composite(overlay, x, y, width, height, x, y, 1, 1, GdkPixbuf.InterpType.NEAREST, 255)
+            self.overlays[icon_name] = overlay
+        return overlay
+
     def do_render(self, ctx, widget, background_area, cell_area, flags):
         if self.pixbuf:
             Gdk.cairo_set_source_pixbuf(ctx, self.pixbuf, cell_area.x, cell_area.y)
             ctx.paint()
         if self.icon:
-            x = cell_area.x+(cell_area.width-self.rate_bg.get_width()) - ALBUM_ART_X_PAD # right
-            y = cell_area.y+(cell_area.height-self.rate_bg.get_height()) # bottom
-            Gdk.cairo_set_source_pixbuf(ctx, self.rate_bg, x, y)
+            overlay = self.get_overlay(widget, self.icon)
+            x = cell_area.x+(cell_area.width-overlay.get_width()) - ALBUM_ART_X_PAD # right
+            y = cell_area.y+(cell_area.height-overlay.get_height()) # bottom
+            Gdk.cairo_set_source_pixbuf(ctx, overlay, x, y)
             ctx.paint()
 
-            icon = widget.get_style_context().lookup_icon_set(self.icon)
-            pixbuf = icon.render_icon_pixbuf(widget.get_style_context(), Gtk.IconSize.MENU)
-            x = cell_area.x+(cell_area.width-pixbuf.get_width())-5 - ALBUM_ART_X_PAD # right
-            y = cell_area.y+(cell_area.height-pixbuf.get_height())-5 # bottom
-            Gdk.cairo_set_source_pixbuf(ctx, pixbuf, x, y)
-            ctx.paint()
+def get_album_art(song):
+    # Song.download already fetches the image; just wait for it
+    filename = song.get_art_file(ALBUM_ART_TIMEOUT)
+    if filename is None:
+        logging.warn('No album art downloaded for %s', song.songName)
+        return (None, song)
+    return (pixbuf_cache.load(filename, ALBUM_ART_SIZE), song)
+
+class PlaybackClock(object):
+    """Calls tick() every interval seconds while running, from one timer.
+
+    start() and stop() may be called any number of times; there is never
+    more than one timer registered with the main loop.
+    """
+    def __init__(self, tick, interval=1):
+        self.tick = tick
+        self.interval = interval
+        self.source_id = None
+
+    @property
+    def running(self):
+        return self.source_id is not None
+
+    def start(self):
+        if self.source_id is None:
+            self.source_id = GLib.timeout_add_seconds(self.interval, self.on_timeout)
 
-def get_album_art(url, *extra):
-    try:
-        with urllib.request.urlopen(url) as f:
-            image = f.read()
-    except urllib.error.HTTPError:
-        logging.warn('Invalid image url received')
-        return (None,) + extra
+    def stop(self):
+        if self.source_id is not None:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
 
-    with contextlib.closing(GdkPixbuf.PixbufLoader()) as loader:
-        loader.set_size(ALBUM_ART_SIZE, ALBUM_ART_SIZE)
-        loader.write(image)
-        return (loader.get_pixbuf(),) + extra
+    def on_timeout(self):
+        self.tick()
+        return True
 
 
 class PithosWindow(Gtk.ApplicationWindow):
@@ -169,6 +208,9 @@ class PithosWindow(Gtk.ApplicationWindow):
             # Changes were made, save new config variable
             self.prefs_dlg.save()
 
+        if self.preferences['cache_key_schedules']:
+            set_schedule_cache_file(os.path.join(PreferencesPithosDialog.config_home, 'pithos_keys.json'))
+
         self.init_core()
         self.init_ui()
 
@@ -183,8 +225,13 @@ class PithosWindow(Gtk.ApplicationWindow):
             self.show_preferences(is_startup=True)
 
         self.pandora = make_pandora(self.cmdopts.test)
+        self.pandora.feedback.on_error = lambda *args: GLib.idle_add(self.on_feedback_error, *args)
+        self.pandora.titles.on_resolved = lambda song: GLib.idle_add(self.on_title_resolved, song)
         self.set_proxy()
         self.set_audio_quality()
+        self.set_cache_size()
+        if self.cmdopts.rescan_library:
+            self.worker_run(self.pandora.library.rescan, (), None, "Rescanning library...", context='library')
         self.pandora_connect()
 
     def init_core(self):
@@ -202,7 +249,9 @@ class PithosWindow(Gtk.ApplicationWindow):
         bus.connect("message::buffering", self.on_gst_buffering)
         bus.connect("message::error", self.on_gst_error)
         bus.connect("message::tag", self.on_gst_tag)
+        bus.connect("message::stream-start", self.on_gst_stream_start)
         self.player.connect("notify::volume", self.on_gst_volume)
+        self.player.connect("about-to-finish", self.on_gst_about_to_finish)
         self.player.connect("notify::source", self.on_gst_source)
         self.time_format = Gst.Format.TIME
 
@@ -210,6 +259,14 @@ class PithosWindow(Gtk.ApplicationWindow):
 
         self.playing = False
         self.current_song_index = None
+        # The about-to-finish handler runs on a GStreamer thread, so what it
+        # needs is worked out beforehand and handed over under this lock.
+        # stop() bumps the generation so a handover made for a song that
+        # was then skipped is ignored.
+        self.gapless_lock = threading.Lock()
+        self.gapless_generation = 0
+        self.gapless_next = None     # (generation, song, uri) to queue when the current one is about to finish
+        self.gapless_pending = None  # (generation, song, previous song's duration) once it has been queued
         self.current_station = None
         self.current_station_id = self.preferences.get('last_station_id')
 
@@ -223,8 +280,16 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.waiting_for_playlist = False
         self.start_new_playlist = False
 
-        self.worker = GObjectWorker()
-        self.art_worker = GObjectWorker()
+        # Keeps the position shown in the current song's row up to date.
+        # Only runs while playing and the window can be seen.
+        self.clock = PlaybackClock(self.update_song_row)
+
+        # Logging in changes the auth tokens every other call uses, so it
+        # runs on its own; everything else may overlap.
+        self.worker = GObjectWorker(threads=3, limits={'net': 2}, exclusive=('login',))
+        self.art_worker = GObjectWorker(threads=2)
+        self.art_jobs = {} # song -> queued or running album art Job
+        self.playlist_job = None
 
         aa = GdkPixbuf.Pixbuf.new_from_file(get_media_file('album'))
 
@@ -284,7 +349,11 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.stations_combo.add_attribute(render_text, "text", 1)
         self.stations_combo.set_row_separator_func(lambda model, iter, data=None: model.get_value(iter, 0) is None, None)
 
-    def worker_run(self, fn, args=(), callback=None, message=None, context='net'):
+        self.connect_after('map', self.on_visibility_changed)
+        self.connect_after('unmap', self.on_visibility_changed)
+        self.connect('window-state-event', self.on_visibility_changed)
+
+    def worker_run(self, fn, args=(), callback=None, message=None, context='net', priority=PRIORITY_DEFAULT):
         if context and message:
             self.statusbar.push(self.statusbar.get_context_id(context), message)
 
@@ -302,7 +371,7 @@ class PithosWindow(Gtk.ApplicationWindow):
             def retry_cb():
                 self.auto_retrying_auth = False
                 if fn is not self.pandora.connect:
-                    self.worker_run(fn, args, callback, message, context)
+                    self.worker_run(fn, args, callback, message, context, priority)
 
             if isinstance(e, PandoraAuthTokenInvalid) and not self.auto_retrying_auth:
                 self.auto_retrying_auth = True
@@ -315,7 +384,7 @@ class PithosWindow(Gtk.ApplicationWindow):
             else:
                 logging.warn(e.traceback)
 
-        self.worker.send(fn, args, cb, eb)
+        return self.worker.send(fn, args, cb, eb, priority, context)
 
     def get_proxy(self):
         """ Get HTTP proxy, first trying preferences then system proxy """
@@ -368,6 +437,9 @@ class PithosWindow(Gtk.ApplicationWindow):
     def set_audio_quality(self):
         self.worker_run('set_audio_quality', (self.preferences['audio_quality'],))
 
+    def set_cache_size(self):
+        self.worker_run('set_cache_size', (int(self.preferences['audio_cache_size']) * 1024**2,))
+
     def pandora_connect(self, message="Logging in...", callback=None):
         if self.preferences['pandora_one']:
             client = client_keys[default_one_client_id]
@@ -411,7 +483,7 @@ class PithosWindow(Gtk.ApplicationWindow):
             if not (i.isQuickMix and i.isCreator):
                 self.stations_model.append((i, i.name))
             if i.id == self.current_station_id:
-                logging.info("Restoring saved station: id = %s"%(i.id))
+                logging.info("Restoring saved station: id = %s", i.id)
                 selected = i
         if not selected:
             selected=self.stations_model[0][0]
@@ -441,6 +513,9 @@ class PithosWindow(Gtk.ApplicationWindow):
         if prev:
             self.update_song_row(prev)
 
+        self.trim_history()
+        song_index = self.current_song_index
+
         if not self.current_song.is_still_valid() and not self.current_song.downloaded:
             self.current_song.message = "Playlist expired"
             self.update_song_row()
@@ -449,20 +524,124 @@ class PithosWindow(Gtk.ApplicationWindow):
         if self.current_song.tired or self.current_song.rating == RATE_BAN:
             return self.next_song()
 
-        logging.info("Starting song: index = %i"%(song_index))
+        self.prioritize_downloads()
+
+        logging.info("Starting song: index = %i", song_index)
         self.buffer_percent = 100
         self.song_started = True
         self.player.set_property("uri", self.current_song.audioUrl)
         self.play()
+        self.begin_song()
+
+    def begin_song(self):
+        """Bookkeeping once current_song has started playing."""
         self.playcount += 1
 
         self.current_song.start_time = time.time()
 
-        self.songs_treeview.scroll_to_cell(song_index, use_align=True, row_align = 1.0)
-        self.songs_treeview.set_cursor(song_index, None, 0)
+        self.songs_treeview.scroll_to_cell(self.current_song_index, use_align=True, row_align = 1.0)
+        self.songs_treeview.set_cursor(self.current_song_index, None, 0)
         self.set_title("Pithos - %s by %s" % (self.current_song.title, self.current_song.artist))
 
         self.emit('song-changed', self.current_song)
+        self.prepare_gapless()
+
+    def prepare_gapless(self):
+        """Pick the song that will follow the current one without a gap."""
+        following = None
+        if self.preferences['gapless_playback'] and self.current_song_index is not None:
+            for i in range(self.current_song_index + 1, len(self.songs_model)):
+                song = self.songs_model[i][0]
+                if song.tired or song.rating == RATE_BAN:
+                    continue
+                if song.is_still_valid() or song.downloaded:
+                    following = song
+                # Anything else goes through start_song so it is reported
+                break
+        uri = following.audioUrl if following else None
+        with self.gapless_lock:
+            self.gapless_next = (self.gapless_generation, following, uri) if following else None
+
+    def on_gst_about_to_finish(self, player):
+        # Called from a GStreamer streaming thread, so it only uses what
+        # prepare_gapless handed over. Setting the uri here makes playbin
+        # move straight on to it when the current one ends, instead of
+        # posting EOS; on_gst_stream_start does the rest.
+        with self.gapless_lock:
+            if self.gapless_next is None:
+                return
+            generation, song, uri = self.gapless_next
+            if song.tired or song.rating == RATE_BAN:
+                return
+            self.gapless_next = None
+            dur_stat, dur = player.query_duration(self.time_format)
+            logging.info("Queueing gapless playback of %s", song.songName)
+            self.gapless_pending = (generation, song, dur if dur_stat else None)
+            player.set_property("uri", uri)
+
+    def on_gst_stream_start(self, bus, message):
+        with self.gapless_lock:
+            pending = self.gapless_pending
+            self.gapless_pending = None
+        if pending is None:
+            return
+        generation, song, prev_duration = pending
+        if generation != self.gapless_generation or song.index is None:
+            return
+
+        prev = self.current_song
+        self.end_song(prev_duration, prev_duration)
+        self.current_song_index = song.index
+        self.update_song_row(prev)
+        self.trim_history()
+        if len(self.songs_model) - self.current_song_index == 1:
+            # Preload next playlist so there's no delay
+            self.get_playlist()
+
+        logging.info("Started song gaplessly: index = %i", self.current_song_index)
+        self.prioritize_downloads()
+        self.buffer_percent = 100
+        self.song_started = True
+        self.begin_song()
+        self.update_song_row()
+        # Its audio-codec tag may have come before it started
+        self.check_if_song_is_ad()
+
+    def trim_history(self):
+        """Forget played songs beyond the song_history preference."""
+        excess = self.current_song_index - int(self.preferences['song_history'])
+        if excess <= 0:
+            return
+        for i in range(excess):
+            song = self.songs_model[0][0]
+            self.songs_model.remove(self.songs_model.get_iter_first())
+            self.cancel_art(song)
+            song.cancel_download()
+            song.index = None
+            song.art_pixbuf = None
+        for row in self.songs_model:
+            row[0].index -= excess
+        self.current_song_index -= excess
+        logging.debug("Dropped %d songs from the history", excess)
+
+    def prioritize_downloads(self):
+        # The current song first, then the next one; the rest of the
+        # playlist keeps the low priority it was queued with.
+        self.current_song.set_download_priority(PRIORITY_HIGH)
+        if self.current_song_index + 1 < len(self.songs_model):
+            self.songs_model[self.current_song_index + 1][0].set_download_priority(PRIORITY_DEFAULT)
+
+    def cancel_downloads(self):
+        # Queued songs after the current one will never be reached
+        start = self.current_song_index + 1 if self.current_song_index is not None else 0
+        for i in range(start, len(self.songs_model)):
+            self.cancel_art(self.songs_model[i][0])
+            self.songs_model[i][0].cancel_download()
+
+    def cancel_art(self, song):
+        job = self.art_jobs.pop(song, None)
+        if job:
+            job.cancel()
 
     def next_song(self, *ignore):
         self.start_song(self.current_song_index + 1)
@@ -476,9 +655,8 @@ class PithosWindow(Gtk.ApplicationWindow):
         if not self.playing:
             self.playing = True
         self.player.set_state(Gst.State.PLAYING)
-        GLib.timeout_add_seconds(1, self.update_song_row)
         self.playpause_image.set_from_icon_name('media-playback-pause-symbolic', Gtk.IconSize.SMALL_TOOLBAR)
-        self.update_song_row()
+        self.update_clock()
         self.emit('play-state-changed', True)
 
     def user_pause(self, *ignore):
@@ -490,21 +668,35 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.player.set_state(Gst.State.PAUSED)
         self.playpause_image.set_from_icon_name('media-playback-start-symbolic', Gtk.IconSize.SMALL_TOOLBAR)
         self.update_song_row()
+        self.update_clock()
         self.emit('play-state-changed', False)
 
 
-    def stop(self):
+    def end_song(self, dur=None, pos=None):
+        """Record how much of the current song was played and emit song-ended."""
         prev = self.current_song
         if prev and prev.start_time:
             prev.finished = True
-            dur_stat, dur = self.player.query_duration(self.time_format)
-            prev.duration = dur//1000000000 if dur_stat else None
-            pos_stat, pos = self.player.query_position(self.time_format)
-            prev.position = pos//1000000000 if pos_stat else None
+            if dur is None:
+                dur_stat, dur = self.player.query_duration(self.time_format)
+                dur = dur if dur_stat else None
+            if pos is None:
+                pos_stat, pos = self.player.query_position(self.time_format)
+                pos = pos if pos_stat else None
+            prev.duration = dur//1000000000 if dur is not None else None
+            prev.position = pos//1000000000 if pos is not None else None
             self.emit("song-ended", prev)
 
+    def stop(self):
+        self.end_song()
+        with self.gapless_lock:
+            self.gapless_generation += 1
+            self.gapless_next = None
+            self.gapless_pending = None
+
         self.playing = False
         self.player.set_state(Gst.State.NULL)
+        self.update_clock()
         self.emit('play-state-changed', False)
 
     def user_playpause(self, *ignore):
@@ -525,7 +717,11 @@ class PithosWindow(Gtk.ApplicationWindow):
 
     def get_playlist(self, start = False):
         self.start_new_playlist = self.start_new_playlist or start
-        if self.waiting_for_playlist: return
+        if self.waiting_for_playlist:
+            if start and self.playlist_job:
+                # A prefetch is already queued and now someone is waiting on it
+                self.playlist_job.set_priority(PRIORITY_DEFAULT)
+            return
 
         if self.gstreamer_errorcount_1 >= self.playcount and self.gstreamer_errorcount_2 >=1:
             logging.warn("Too many gstreamer errors. Not retrying")
@@ -534,11 +730,12 @@ class PithosWindow(Gtk.ApplicationWindow):
             return
 
         def art_callback(t):
-            pixbuf, song, index = t
-            if index<len(self.songs_model) and self.songs_model[index][0] is song: # in case the playlist has been reset
-                logging.info("Downloaded album art for %i"%song.index)
+            pixbuf, song = t
+            self.art_jobs.pop(song, None)
+            if song.index is not None: # in case it has dropped out of the history
+                logging.info("Downloaded album art for %i", song.index)
                 song.art_pixbuf = pixbuf
-                self.songs_model[index][3]=pixbuf
+                self.songs_model[song.index][3]=pixbuf
                 self.update_song_row(song)
 
         def callback(l):
@@ -550,11 +747,14 @@ class PithosWindow(Gtk.ApplicationWindow):
 
                 i.art_pixbuf = None
                 if i.artRadio:
-                    self.art_worker.send(get_album_art, (i.artRadio, i, i.index), art_callback)
+                    self.art_jobs[i] = self.art_worker.send(get_album_art, (i,), art_callback,
+                                                            priority=PRIORITY_LOW, context='art')
 
             self.statusbar.pop(self.statusbar.get_context_id('net'))
             if self.start_new_playlist:
                 self.start_song(start_index)
+            else:
+                self.prepare_gapless()
 
             self.gstreamer_errorcount_2 = self.gstreamer_errorcount_1
             self.gstreamer_errorcount_1 = 0
@@ -563,7 +763,9 @@ class PithosWindow(Gtk.ApplicationWindow):
             self.start_new_playlist = False
 
         self.waiting_for_playlist = True
-        self.worker_run(self.current_station.get_playlist, (), callback, "Getting songs...")
+        priority = PRIORITY_DEFAULT if start else PRIORITY_LOW
+        self.playlist_job = self.worker_run(self.current_station.get_playlist, (), callback, "Getting songs...",
+                                            priority=priority)
 
     def error_dialog(self, message, retry_cb, submsg=None):
         dialog = self.builder.get_object("error_dialog")
@@ -607,11 +809,16 @@ class PithosWindow(Gtk.ApplicationWindow):
     def station_changed(self, station, reconnecting=False):
         if station is self.current_station: return
         self.waiting_for_playlist = False
+        if self.playlist_job and self.playlist_job.cancel():
+            # Songs for the previous station are no longer wanted
+            self.statusbar.pop(self.statusbar.get_context_id('net'))
+        self.playlist_job = None
         if not reconnecting:
             self.stop()
+            self.cancel_downloads()
             #self.current_song_index = None
             #self.songs_model.clear()
-        logging.info("Selecting station %s; total = %i" % (station.id, len(self.stations_model)))
+        logging.info("Selecting station %s; total = %i", station.id, len(self.stations_model))
         self.current_station_id = station.id
         self.current_station = station
         if not reconnecting:
@@ -637,28 +844,37 @@ class PithosWindow(Gtk.ApplicationWindow):
         self.next_song()
 
     def gst_tag_handler(self, tag_info):
+        trace = tracing()
         def handler(_x, tag, _y):
-            # An exhaustive list of tags is available at
-            # https://developer.gnome.org/gstreamer/stable/gstreamer-GstTagList.html
-            # but Pandora seems to only use those
-            if tag == 'datetime':
-                _, datetime = tag_info.get_date_time(tag)
-                value = datetime.to_iso8601_string()
-            elif tag in ('container-format', 'audio-codec'):
-                _, value = tag_info.get_string(tag)
-            elif tag in ('bitrate', 'maximum-bitrate', 'minimum-bitrate'):
-                _, value = tag_info.get_uint(tag)
-            else:
-                value = 'Don\'t know the type of this'
+            if trace:
+                # An exhaustive list of tags is available at
+                # https://developer.gnome.org/gstreamer/stable/gstreamer-GstTagList.html
+                # but Pandora seems to only use those
+                if tag == 'datetime':
+                    _, datetime = tag_info.get_date_time(tag)
+                    value = datetime.to_iso8601_string()
+                elif tag in ('container-format', 'audio-codec'):
+                    _, value = tag_info.get_string(tag)
+                elif tag in ('bitrate', 'maximum-bitrate', 'minimum-bitrate'):
+                    _, value = tag_info.get_uint(tag)
+                else:
+                    value = 'Don\'t know the type of this'
 
-            logging.debug('Found tag "%s" in stream: "%s" (type: %s)' % (tag, value, type(value)))
+                logging.debug('Found tag "%s" in stream: "%s" (type: %s)', tag, value, type(value))
+
+            if self.gapless_pending:
+                # Tags of the queued song can arrive before it starts
+                song = self.gapless_pending[1]
+                if tag == 'bitrate':
+                    _, song.bitrate = tag_info.get_uint(tag)
+                return
 
             if tag == 'audio-codec':
                 # At that point we should have duration information, check for ads
                 self.check_if_song_is_ad()
 
             if tag == 'bitrate':
-                self.current_song.bitrate = value
+                _, self.current_song.bitrate = tag_info.get_uint(tag)
                 self.update_song_row()
 
         return handler
@@ -688,6 +904,7 @@ class PithosWindow(Gtk.ApplicationWindow):
                     self.skips = 0
                     logging.info('Not an Ad..')
                     self.current_song.is_ad = False
+                    self.current_song.duration = dur_int
                     self.current_song.store()
 
     def on_gst_tag(self, bus, message):
@@ -704,6 +921,13 @@ class PithosWindow(Gtk.ApplicationWindow):
         # 100% doesn't mean the entire song is downloaded, but it does mean that it's safe to play.
         # trying to play before 100% will cause stuttering.
         percent = message.parse_buffering()
+        if (percent < 100 and self.buffer_percent == 100
+                and self.preferences['audio_quality'] == AUTOMATIC_QUALITY):
+            pos_stat, pos = self.player.query_position(self.time_format)
+            if pos_stat and pos > 0:
+                # Ran out of audio in the middle of the song, rather than
+                # filling the buffer before it starts
+                self.pandora.quality.stalled()
         self.buffer_percent = percent
         if percent < 100:
             self.player.set_state(Gst.State.PAUSED)
@@ -712,7 +936,7 @@ class PithosWindow(Gtk.ApplicationWindow):
                 self.play()
                 self.song_started = True
         self.update_song_row()
-        logging.debug("Buffering (%i%%)"%self.buffer_percent)
+        logging.debug("Buffering (%i%%)", self.buffer_percent)
 
     def set_volume_cb(self, volume):
         # Convert to the cubic scale that the volume slider uses
@@ -736,10 +960,23 @@ class PithosWindow(Gtk.ApplicationWindow):
             soup.proxy_id = user
             soup.proxy_pw = password
 
+    def song_description(self, song):
+        """Markup for the title, artist and album lines of a song's row.
+
+        It is kept on the song, and only rebuilt if the title or whether
+        the song is an ad changes.
+        """
+        key = (song.title, song.is_ad)
+        if song.markup is None or song.markup[0] != key:
+            if song.is_ad:
+                description = "<b><big>Commercial Advertisement</big></b>\n<b>Pandora</b>"
+            else:
+                description = "<b><big>%s</big></b>\nby <b>%s</b>\n<small>from <i>%s</i></small>" % (
+                    html.escape(song.title), html.escape(song.artist), html.escape(song.album))
+            song.markup = (key, description)
+        return song.markup[1]
+
     def song_text(self, song):
-        title = html.escape(song.title)
-        artist = html.escape(song.artist)
-        album = html.escape(song.album)
         msg = []
         if song is self.current_song:
             dur_stat, dur_int = self.player.query_duration(self.time_format)
@@ -762,12 +999,7 @@ class PithosWindow(Gtk.ApplicationWindow):
         if not msg:
             msg = " "
 
-        if song.is_ad:
-            description = "<b><big>Commercial Advertisement</big></b>\n<b>Pandora</b>"
-        else:
-            description = "<b><big>%s</big></b>\nby <b>%s</b>\n<small>from <i>%s</i></small>" % (title, artist, album)
-
-        return "%s\n<small>%s</small>" % (description, msg)
+        return "%s\n<small>%s</small>" % (self.song_description(song), msg)
 
     def song_icon(self, song):
         if song.tired:
@@ -780,11 +1012,37 @@ class PithosWindow(Gtk.ApplicationWindow):
     def update_song_row(self, song = None):
         if song is None:
             song = self.current_song
-        if song:
-            self.songs_model[song.index][1] = self.song_text(song)
-            self.songs_model[song.index][2] = self.song_icon(song) or ""
+        if song and song.index is not None:
+            # Setting a value redraws the row even if it is the same, and
+            # most clock ticks are while the position has not moved on
+            row = self.songs_model[song.index]
+            text = self.song_text(song)
+            if row[1] != text:
+                row[1] = text
+            icon = self.song_icon(song) or ""
+            if row[2] != icon:
+                row[2] = icon
         return self.playing
 
+    def window_is_showing(self):
+        window = self.get_window()
+        return (self.get_mapped() and window is not None
+                and not window.get_state() & Gdk.WindowState.ICONIFIED)
+
+    def update_clock(self):
+        """Run the playback clock only when there is something to show."""
+        if self.playing and self.window_is_showing():
+            if not self.clock.running:
+                # The row was not updated while the clock was stopped
+                self.update_song_row()
+            self.clock.start()
+        else:
+            self.clock.stop()
+
+    def on_visibility_changed(self, *ignore):
+        self.update_clock()
+        return False
+
     def stations_combo_changed(self, widget):
         index = widget.get_active()
         if index>=0:
@@ -808,46 +1066,63 @@ class PithosWindow(Gtk.ApplicationWindow):
         if sel:
             return self.songs_treeview.get_model().get_value(sel[1], 0)
 
+    def rate_song(self, song, rating):
+        # The rating is shown right away; the feedback queue sends it later
+        song.queue_rating(rating)
+        self.update_song_row(song)
+        self.emit('song-rating-changed', song)
+
+    def on_title_resolved(self, song):
+        self.update_song_row(song)
+        if song is self.current_song:
+            self.set_title("Pithos - %s by %s" % (song.title, song.artist))
+
+    def on_feedback_error(self, song, rating, error):
+        # The queue has put the song's previous rating back
+        self.update_song_row(song)
+        self.emit('song-rating-changed', song)
+
+        def retry_cb():
+            self.auto_retrying_auth = False
+            self.rate_song(song, rating)
+
+        if isinstance(error, PandoraAuthTokenInvalid) and not self.auto_retrying_auth:
+            self.auto_retrying_auth = True
+            logging.info("Automatic reconnect after invalid auth token")
+            self.pandora_connect("Reconnecting...", retry_cb)
+        else:
+            self.error_dialog(error.message, retry_cb, submsg=error.submsg)
+
     def love_song(self, song=None):
         song = song or self.current_song
-        def callback(l):
-            self.update_song_row(song)
-            self.emit('song-rating-changed', song)
-        self.worker_run(song.rate, (RATE_LOVE,), callback, "Loving song...")
-
+        self.rate_song(song, RATE_LOVE)
 
     def ban_song(self, song=None):
         song = song or self.current_song
-        def callback(l):
-            self.update_song_row(song)
-            self.emit('song-rating-changed', song)
-        self.worker_run(song.rate, (RATE_BAN,), callback, "Banning song...")
+        self.rate_song(song, RATE_BAN)
         if song is self.current_song:
             self.next_song()
 
     def unrate_song(self, song=None):
         song = song or self.current_song
-        def callback(l):
-            self.update_song_row(song)
-            self.emit('song-rating-changed', song)
-        self.worker_run(song.rate, (RATE_NONE,), callback, "Removing song rating...")
+        self.rate_song(song, RATE_NONE)
 
     def tired_song(self, song=None):
         song = song or self.current_song
         def callback(l):
             self.update_song_row(song)
             self.emit('song-rating-changed', song)
-        self.worker_run(song.set_tired, (), callback, "Putting song on shelf...")
+        self.worker_run(song.set_tired, (), callback, "Putting song on shelf...", priority=PRIORITY_HIGH)
         if song is self.current_song:
             self.next_song()
 
     def bookmark_song(self, song=None):
         song = song or self.current_song
-        self.worker_run(song.bookmark, (), None, "Bookmarking...")
+        self.worker_run(song.bookmark, (), None, "Bookmarking...", priority=PRIORITY_HIGH)
 
     def bookmark_song_artist(self, song=None):
         song = song or self.current_song
-        self.worker_run(song.bookmark_artist, (), None, "Bookmarking...")
+        self.worker_run(song.bookmark_artist, (), None, "Bookmarking...", priority=PRIORITY_HIGH)
 
     def on_menuitem_love(self, widget):
         self.love_song(self.selected_song())
@@ -898,7 +1173,7 @@ class PithosWindow(Gtk.ApplicationWindow):
                 self.start_song(self.selected_song().index)
 
     def set_player_volume(self, value):
-        logging.info('%.3f' % value)
+        logging.info('%.3f', value)
         # Use a cubic scale for volume. This matches what PulseAudio uses.
         volume = math.pow(value, 3)
         self.player.set_property("volume", volume)
@@ -942,6 +1217,8 @@ class PithosWindow(Gtk.ApplicationWindow):
                     self.set_proxy()
                 if self.preferences['audio_quality'] != old_prefs['audio_quality']:
                     self.set_audio_quality()
+                if self.preferences['audio_cache_size'] != old_prefs['audio_cache_size']:
+                    self.set_cache_size()
                 if (   self.preferences['username'] != old_prefs['username']
                     or self.preferences['password'] != old_prefs['password']
                     or self.preferences['pandora_one'] != old_prefs['pandora_one']):
@@ -977,8 +1254,17 @@ class PithosWindow(Gtk.ApplicationWindow):
     def on_destroy(self, widget, data=None):
         """on_destroy - called when the PithosWindow is close. """
         self.stop()
+        # Ratings are sent after a short delay; don't lose the last one
+        if not self.pandora.feedback.flush():
+            logging.warning("Quitting with song ratings still unsent")
         self.preferences['last_station_id'] = self.current_station_id
         self.prefs_dlg.save()
+        if self.preferences['rpc_stats_file']:
+            try:
+                self.pandora.stats.dump(os.path.expanduser(self.preferences['rpc_stats_file']))
+            except IOError as e:
+                logging.error("Could not write RPC stats: %s", e)
+        self.pandora.streams.close()
         self.quit()
 
 def NewPithosWindow(app, options):
@@ -1034,6 +1320,7 @@ class PithosApplication(Gtk.Application):
         parser = argparse.ArgumentParser()
         parser.add_argument("-v", "--verbose", action="count", default=0, dest="verbose", help="Show debug messages")
         parser.add_argument("-t", "--test", action="store_true", dest="test", help="Use a mock web interface instead of connecting to the real Pandora server")
+        parser.add_argument("--rescan-library", action="store_true", dest="rescan_library", help="Rebuild the index of stored songs from the Music folder")
         self.options = parser.parse_args(args.get_arguments()[1:])
 
         # First, get rid of existing logging handlers due to call in header as per
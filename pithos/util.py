@@ -15,6 +15,7 @@
 ### END LICENSE
 
 import logging
+import hashlib
 import webbrowser
 from urllib.parse import splittype, splituser, splitpasswd
 
@@ -50,3 +51,38 @@ def open_browser(url):
             os.wait() # workaround for http://bugs.python.org/issue5993
         except:
             pass
+
+# Debug tracing. Request and response bodies are only turned into log text
+# when debug logging is on, and long ones are cut short with a hash of the
+# whole body so identical payloads can still be matched up.
+TRACE_MAX_LENGTH = 1024
+
+def tracing():
+    """True if debug messages are logged. Guard trace-only work with this."""
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+class TracePayload(object):
+    """Lazily formats a payload for logging.debug("%s", TracePayload(data))"""
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        payload = self.payload
+        if isinstance(payload, bytes):
+            text = payload.decode('utf-8', 'replace')
+        else:
+            text = str(payload)
+            payload = text.encode('utf-8')
+        if len(text) <= TRACE_MAX_LENGTH:
+            return text
+        return "%s... (%d bytes, sha1 %s)" % (text[:TRACE_MAX_LENGTH], len(payload),
+                                             hashlib.sha1(payload).hexdigest()[:12])
+
+def set_log_level(name):
+    """Change the root log level at runtime, e.g. set_log_level('debug')"""
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError("Unknown log level %s" % name)
+    logging.getLogger().setLevel(level)